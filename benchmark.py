@@ -0,0 +1,597 @@
+"""
+Offline benchmark for the bot's command handlers.
+
+Drives /playbot, the PlayerControls buttons and check_server_status against local
+stand-ins: a fake YoutubeDL with configurable latency, a local HTTP server serving a
+generated audio file, a fake VoiceClient that consumes frames in real time and dummy
+status endpoints. No Discord token or YouTube access is needed.
+
+The HTTP stand-ins run in a separate process so their CPU isn't counted against the
+bot. `--codec opus` serves an Opus track instead of PCM, which exercises passthrough
+and the loop buffer (needs ffmpeg; a short --track-seconds keeps the loop phase quick).
+
+    python benchmark.py                      # 1, 10 and 100 concurrent guilds
+    python benchmark.py --guilds 1 10 --extract-latency 1.5 --json bench_output.txt
+    python benchmark.py --guilds 1 10 --codec opus --track-seconds 10
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler, BaseHTTPRequestHandler
+from types import SimpleNamespace
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_RATE = 48000
+FRAME_BYTES = 3840
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the music bot")
+    parser.add_argument('--guilds', type=int, nargs='+', default=[1, 10, 100], help="Concurrent guild counts to run")
+    parser.add_argument('--unique-tracks', type=int, default=10, help="Distinct videos requested per round")
+    parser.add_argument('--extract-latency', type=float, default=0.5, help="Seconds the fake YoutubeDL takes")
+    parser.add_argument('--track-seconds', type=int, default=30, help="Length of the generated audio file")
+    parser.add_argument('--play-seconds', type=float, default=5.0, help="Steady-state playback window for CPU sampling")
+    parser.add_argument('--status-servers', type=int, default=20, help="Dummy status endpoints per round")
+    parser.add_argument('--codec', choices=['pcm', 'opus'], default='pcm', help="Codec the fake YouTube streams use")
+    parser.add_argument('--json', metavar='FILE', help="Also write the results as JSON")
+    parser.add_argument('--verbose', action='store_true', help="Show the bot's log output")
+    # Internal: run the HTTP stand-ins for the parent benchmark process
+    parser.add_argument('--fixtures', metavar='DIR', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    if len(samples) == 1:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method='inclusive')[int(q * 100) - 1]
+
+def write_sine_wav(path, seconds):
+    frames = bytearray()
+    for i in range(SAMPLE_RATE * seconds):
+        sample = int(12000 * math.sin(2 * math.pi * 440 * i / SAMPLE_RATE))
+        frames += sample.to_bytes(2, 'little', signed=True) * 2
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(bytes(frames))
+
+def encode_opus(wav_path, path):
+    """Encode the generated track to Opus in WebM, like the audio YouTube serves."""
+    subprocess.run(
+        ['ffmpeg', '-y', '-loglevel', 'error', '-i', wav_path, '-c:a', 'libopus', '-b:a', '128k', path],
+        check=True
+    )
+
+class QuietFileHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class StatusHandler(BaseHTTPRequestHandler):
+    delay = 0.0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+def serve(handler, directory=None):
+    """Start a threaded HTTP server on a free local port and return it."""
+    if directory:
+        factory = lambda *args, **kwargs: handler(*args, directory=directory, **kwargs)
+    else:
+        factory = handler
+    server = ThreadingHTTPServer(('127.0.0.1', 0), factory)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def free_port():
+    """A local port with nothing listening on it, for probes that must fail."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StatusHandler)
+    port = server.server_address[1]
+    server.server_close()
+    return port
+
+def run_fixtures(directory, status_servers):
+    """
+    Serve the audio files in `directory` and the status endpoints, print their ports
+    as one JSON line and keep serving until stdin is closed by the parent.
+    Every fifth endpoint is left dead and every fifth after that answers slowly.
+    """
+    audio_server = serve(QuietFileHandler, directory=directory)
+    servers = [audio_server]
+    status_ports = {}
+    for i in range(status_servers):
+        if i % 5 == 4:
+            continue
+        handler = type(f"StatusHandler{i}", (StatusHandler,), {'delay': 0.2 if i % 5 == 3 else 0.0})
+        server = serve(handler)
+        servers.append(server)
+        status_ports[i] = server.server_address[1]
+    print(json.dumps({'audio_port': audio_server.server_address[1], 'status_ports': status_ports}), flush=True)
+    sys.stdin.read()
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def start_fixtures(directory, status_servers):
+    """Run `run_fixtures` in a child process and return (process, ports)."""
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--fixtures', directory, '--status-servers', str(status_servers)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+    )
+    return process, json.loads(process.stdout.readline())
+
+# --- Stand-ins -------------------------------------------------------------
+
+class FakeYoutubeDL:
+    """Replaces yt_dlp.YoutubeDL; sleeps for `latency` and points at the local audio server."""
+    latency = 0.5
+    audio_url = None
+    duration = 30
+    acodec = 'pcm_s16le'
+    ext = 'wav'
+    calls = 0
+
+    def __init__(self, opts=None):
+        self.opts = opts
+
+    def extract_info(self, url, download=False):
+        FakeYoutubeDL.calls += 1
+        time.sleep(self.latency)
+        video_id = bot.extract_video_id(url)
+        return {
+            'id': video_id,
+            'title': f"Benchmark track {video_id}",
+            'url': f"{self.audio_url}?v={video_id}&expire={int(time.time()) + 6 * 3600}",
+            'duration': self.duration,
+            'acodec': self.acodec,
+            'ext': self.ext,
+        }
+
+class HttpPcmSource:
+    """Used instead of FFmpeg when it isn't installed: reads raw frames from the WAV over HTTP."""
+    def __init__(self, url):
+        import urllib.request
+        self.response = urllib.request.urlopen(url)
+        self.response.read(44)
+
+    def read(self):
+        data = self.response.read(FRAME_BYTES)
+        return data if len(data) == FRAME_BYTES else b''
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        self.response.close()
+
+class FakeVoiceClient:
+    """Consumes frames from the source at real-time pace on its own thread, like discord's AudioPlayer."""
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+        self.connected = True
+        self._source = None
+        self._paused = threading.Event()
+        self._stop = None
+        self.first_frame_at = None
+        self.frames = 0
+
+    @property
+    def source(self):
+        return self._source
+
+    def is_connected(self):
+        return self.connected
+
+    def is_playing(self):
+        return self._source is not None and not self._paused.is_set()
+
+    def is_paused(self):
+        return self._source is not None and self._paused.is_set()
+
+    def play(self, source, after=None):
+        if self._source is not None:
+            raise RuntimeError("Already playing audio.")
+        self._source = source
+        self._paused.clear()
+        self._stop = stop = threading.Event()
+        threading.Thread(target=self._run, args=(source, stop, after), daemon=True).start()
+
+    def _run(self, source, stop, after):
+        next_at = time.perf_counter()
+        while not stop.is_set():
+            if self._paused.is_set():
+                time.sleep(0.02)
+                next_at = time.perf_counter()
+                continue
+            data = source.read()
+            if not data:
+                break
+            if self.first_frame_at is None:
+                self.first_frame_at = time.perf_counter()
+            self.frames += 1
+            next_at += 0.02
+            time.sleep(max(0.0, next_at - time.perf_counter()))
+        source.cleanup()
+        if self._source is source:
+            self._source = None
+        if after:
+            after(None)
+
+    def stop(self):
+        if self._stop:
+            self._stop.set()
+        self._source = None
+
+    def pause(self):
+        self._paused.set()
+
+    def resume(self):
+        self._paused.clear()
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, force=False):
+        self.stop()
+        self.connected = False
+        self.guild.voice_client = None
+
+class FakeVoiceChannel:
+    def __init__(self, guild, channel_id):
+        self.guild = guild
+        self.id = channel_id
+        self.name = f"voice-{channel_id}"
+        self.members = []
+
+    async def connect(self):
+        self.guild.voice_client = FakeVoiceClient(self.guild, self)
+        return self.guild.voice_client
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self.voice_client = None
+        self.voice_channel = FakeVoiceChannel(self, guild_id * 10)
+
+    def get_channel(self, channel_id):
+        return self.voice_channel if channel_id == self.voice_channel.id else None
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def defer(self, **kwargs):
+        pass
+
+    async def send_message(self, content=None, **kwargs):
+        self.interaction.replies.append((time.perf_counter(), content))
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        self.interaction.replies.append((time.perf_counter(), content))
+
+class FakeInteraction:
+    def __init__(self, guild, user):
+        self.guild = guild
+        self.user = user
+        self.channel_id = guild.id * 10 + 1
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.replies = []
+        self.created = time.perf_counter()
+        self.token = f"token-{id(self)}"
+
+def make_user(user_id, channel):
+    return SimpleNamespace(
+        id=user_id, mention=f"<@{user_id}>", bot=False,
+        voice=SimpleNamespace(channel=channel),
+        guild_permissions=SimpleNamespace(administrator=True),
+    )
+
+class FakeMessage:
+    def __init__(self, channel, message_id, content):
+        self.channel = channel
+        self.id = message_id
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+        return self
+
+class FakeTextChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.messages = {}
+
+    async def send(self, content=None, **kwargs):
+        message = FakeMessage(self, len(self.messages) + 1, content)
+        self.messages[message.id] = message
+        return message
+
+    def get_partial_message(self, message_id):
+        return self.messages[message_id]
+
+# --- Rounds ----------------------------------------------------------------
+
+def children_cpu(voice_clients):
+    """CPU seconds used so far by the FFmpeg processes behind the given voice clients."""
+    total = 0.0
+    for voice_client in voice_clients:
+        source = voice_client.source
+        process = source.ffmpeg_process() if isinstance(source, bot.MeteredSource) else None
+        cpu = bot.process_cpu_seconds(process.pid) if process else None
+        total += cpu or 0.0
+    return total
+
+def reset_bot_state():
+    bot.guild_queues.clear()
+    bot.pending_plays.clear()
+    bot.stream_cache.entries.clear()
+    bot.stream_cache.hits = bot.stream_cache.misses = 0
+    # The status endpoints are reused across rounds, so start each round with no history
+    bot.status_monitor.histories.clear()
+    bot.server_latencies.clear()
+
+async def sample_cpu(voice_clients, seconds):
+    """
+    Percent of one core used per playing stream over `seconds`, counting this process
+    (the bot, with the HTTP stand-ins out of process) and the FFmpeg children.
+    """
+    cpu_before = time.process_time() + children_cpu(voice_clients)
+    frames_before = sum(vc.frames for vc in voice_clients)
+    await asyncio.sleep(seconds)
+    cpu_used = time.process_time() + children_cpu(voice_clients) - cpu_before
+    frames = sum(vc.frames for vc in voice_clients) - frames_before
+    playing = sum(1 for vc in voice_clients if vc.is_playing())
+    return cpu_used / seconds / max(playing, 1) * 100, frames, playing
+
+def source_modes(voice_clients):
+    return sorted({vc.source.mode for vc in voice_clients if isinstance(vc.source, bot.MeteredSource)})
+
+async def measure_loop_buffer(guilds, users, voice_clients, args):
+    """
+    Turn Loop on everywhere and wait for the tracks to come round again, which should
+    replay from the captured Opus frames; then sample CPU and turn Loop back off.
+    Returns (cpu percent per stream, streams replaying from the buffer).
+    """
+    for guild, user in zip(guilds, users):
+        controls = getattr(guild.voice_client, 'player_controls', None)
+        if controls:
+            await controls.loop.callback(FakeInteraction(guild, user))
+    deadline = time.perf_counter() + args.track_seconds + 15
+    while time.perf_counter() < deadline and any(
+        not isinstance(vc.source, bot.MeteredSource) or vc.source.mode != 'buffer' for vc in voice_clients
+    ):
+        await asyncio.sleep(0.05)
+    cpu_per_stream, _, _ = await sample_cpu(voice_clients, args.play_seconds)
+    buffered = sum(
+        1 for vc in voice_clients if isinstance(vc.source, bot.MeteredSource) and vc.source.mode == 'buffer'
+    )
+    for guild, user in zip(guilds, users):
+        controls = getattr(guild.voice_client, 'player_controls', None)
+        if controls:
+            await controls.loop.callback(FakeInteraction(guild, user))
+    return cpu_per_stream, buffered
+
+async def run_round(guild_count, args, status_channel, status_ports):
+    reset_bot_state()
+    FakeYoutubeDL.calls = 0
+    guilds = [FakeGuild(1000 + i) for i in range(guild_count)]
+    users = [make_user(500000 + i, guild.voice_channel) for i, guild in enumerate(guilds)]
+    for guild, user in zip(guilds, users):
+        await bot.storage.add_whitelist(guild.id, str(user.id))
+
+    # /playbot in every guild at once
+    interactions = [FakeInteraction(guild, user) for guild, user in zip(guilds, users)]
+    urls = [f"https://www.youtube.com/watch?v=bench{i % args.unique_tracks:06d}" for i in range(guild_count)]
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        bot.playbot.callback(interaction, url) for interaction, url in zip(interactions, urls)
+    ))
+    playbot_wall = time.perf_counter() - started
+    playbot_latency = [interaction.replies[-1][0] - interaction.created for interaction in interactions if interaction.replies]
+    failures = sum(
+        1 for interaction in interactions
+        if not interaction.replies or interaction.replies[-1][1] != "Now playing your requested audio."
+    )
+
+    # Wait for first audio everywhere, then sample CPU over a steady window
+    voice_clients = [guild.voice_client for guild in guilds if guild.voice_client]
+    deadline = time.perf_counter() + 30
+    while time.perf_counter() < deadline and any(vc.first_frame_at is None for vc in voice_clients):
+        await asyncio.sleep(0.01)
+    ttfa = [
+        vc.first_frame_at - interaction.created
+        for vc, interaction in zip(voice_clients, interactions) if vc.first_frame_at
+    ]
+    modes = source_modes(voice_clients)
+    cpu_per_stream, frames, playing = await sample_cpu(voice_clients, args.play_seconds)
+
+    # Opus tracks are captured as they play; a looped replay should come from that buffer
+    loop_cpu_per_stream = buffered_streams = None
+    if args.codec == 'opus':
+        loop_cpu_per_stream, buffered_streams = await measure_loop_buffer(guilds, users, voice_clients, args)
+
+    # PlayerControls buttons
+    button_latency = []
+    for guild, user in zip(guilds, users):
+        controls = getattr(guild.voice_client, 'player_controls', None)
+        if not controls:
+            continue
+        for button in (controls.volume_up, controls.pause, controls.resume, controls.loop, controls.volume_down):
+            interaction = FakeInteraction(guild, user)
+            await button.callback(interaction)
+            button_latency.append(time.perf_counter() - interaction.created)
+
+    # Status polling against live, slow and dead endpoints
+    servers = {}
+    for i in range(args.status_servers):
+        if i % 5 == 4:
+            servers[f"dead-{i}"] = {'ip': '127.0.0.1', 'port': free_port()}
+        else:
+            servers[f"server-{i}"] = {'ip': '127.0.0.1', 'port': status_ports[str(i)]}
+    bot.save_servers(servers)
+    bot.save_status_channel(str(status_channel.id))
+    started = time.perf_counter()
+    await bot.check_server_status.coro()
+    status_tick = time.perf_counter() - started
+    # Right after a full tick nothing is due, so the next one should probe nothing
+    skipped_before = bot.metrics.probes_skipped.get()
+    started = time.perf_counter()
+    await bot.check_server_status.coro()
+    status_repeat = time.perf_counter() - started
+    probes_skipped = bot.metrics.probes_skipped.get() - skipped_before
+
+    for guild in guilds:
+        if guild.voice_client:
+            controls = getattr(guild.voice_client, 'player_controls', None)
+            if controls:
+                controls.forced_stop = True
+            bot.clear_guild_playback(guild.id, disconnecting=True)
+            await guild.voice_client.disconnect()
+    await asyncio.sleep(0.1)
+
+    return {
+        'guilds': guild_count,
+        'codec': args.codec,
+        'source_modes': modes,
+        'playbot_per_second': guild_count / playbot_wall if playbot_wall else None,
+        'playbot_p50': percentile(playbot_latency, 0.5),
+        'playbot_p99': percentile(playbot_latency, 0.99),
+        'ttfa_p50': percentile(ttfa, 0.5),
+        'ttfa_p99': percentile(ttfa, 0.99),
+        'button_p50': percentile(button_latency, 0.5),
+        'button_p99': percentile(button_latency, 0.99),
+        'failures': failures,
+        'extractions': FakeYoutubeDL.calls,
+        'streams': playing,
+        'frames_per_second': frames / args.play_seconds,
+        'cpu_percent_per_stream': cpu_per_stream,
+        'loop_cpu_percent_per_stream': loop_cpu_per_stream,
+        'buffered_streams': buffered_streams,
+        'status_tick_seconds': status_tick,
+        'status_repeat_seconds': status_repeat,
+        'status_probes_skipped': probes_skipped,
+    }
+
+def print_results(results):
+    def ms(value):
+        return f"{value * 1000:8.1f}" if value is not None else "     n/a"
+
+    def pct(value):
+        return f"{value:8.2f}" if value is not None else "     n/a"
+
+    if results:
+        modes = sorted({mode for r in results for mode in r['source_modes']})
+        print(f"Codec: {results[0]['codec']}; playback modes: {', '.join(modes) or 'none'}")
+    print(
+        f"{'guilds':>6} {'ops/s':>7} {'play p50':>8} {'play p99':>8} {'ttfa p50':>8} {'ttfa p99':>8} "
+        f"{'btn p99':>8} {'fail':>4} {'extr':>4} {'cpu/str%':>8} {'loop%':>8} {'status s':>8} {'repeat s':>8} "
+        f"{'skipped':>7}"
+    )
+    for r in results:
+        print(
+            f"{r['guilds']:>6} {r['playbot_per_second']:>7.1f} {ms(r['playbot_p50'])} {ms(r['playbot_p99'])} "
+            f"{ms(r['ttfa_p50'])} {ms(r['ttfa_p99'])} {ms(r['button_p99'])} {r['failures']:>4} "
+            f"{r['extractions']:>4} {pct(r['cpu_percent_per_stream'])} {pct(r['loop_cpu_percent_per_stream'])} "
+            f"{r['status_tick_seconds']:>8.2f} "
+            f"{r['status_repeat_seconds']:>8.2f} {r['status_probes_skipped']:>7}"
+        )
+    print(
+        "Latencies in ms; cpu/str% is percent of one core per playing stream, "
+        "loop% the same while replaying from the loop buffer (opus only)."
+    )
+
+async def main(args, status_ports):
+    bot.client.loop = asyncio.get_running_loop()
+    bot.client._connection.user = SimpleNamespace(id=1, bot=True)
+    status_channel = FakeTextChannel(42)
+    bot.client.get_channel = lambda channel_id: status_channel if int(channel_id) == status_channel.id else None
+
+    results = []
+    for guild_count in args.guilds:
+        result = await run_round(guild_count, args, status_channel, status_ports)
+        results.append(result)
+        print(f"Finished {guild_count} guild(s)", file=sys.stderr)
+
+    await bot.close_http_session()
+    bot.extraction_service.shutdown()
+    return results
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.fixtures:
+        run_fixtures(args.fixtures, args.status_servers)
+        sys.exit()
+    # Dead status endpoints are expected, so their errors are hidden unless asked for
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    # Run inside a scratch directory so the bot's JSON files don't touch the real ones
+    workdir = tempfile.mkdtemp(prefix='musicbot-bench-')
+    os.chdir(workdir)
+    os.environ.setdefault('STREAM_CACHE_PERSIST', '0')
+    os.environ['EXTRACT_MODE'] = 'thread'
+    os.environ.pop('METRICS_PORT', None)
+    sys.path.insert(0, REPO_DIR)
+    import_started = time.perf_counter()
+    import bot
+    import_seconds = time.perf_counter() - import_started
+    hash_started = time.perf_counter()
+    bot.command_tree_hash(bot.client.tree)
+    hash_seconds = time.perf_counter() - hash_started
+
+    write_sine_wav(os.path.join(workdir, 'track.wav'), args.track_seconds)
+    track = 'track.wav'
+    if args.codec == 'opus':
+        if shutil.which('ffmpeg') is None:
+            sys.exit("--codec opus needs ffmpeg to encode and stream the track")
+        encode_opus(os.path.join(workdir, 'track.wav'), os.path.join(workdir, 'track.webm'))
+        track = 'track.webm'
+        FakeYoutubeDL.acodec = 'opus'
+        FakeYoutubeDL.ext = 'webm'
+    fixtures, ports = start_fixtures(workdir, args.status_servers)
+    FakeYoutubeDL.audio_url = f"http://127.0.0.1:{ports['audio_port']}/{track}"
+    FakeYoutubeDL.latency = args.extract_latency
+    FakeYoutubeDL.duration = args.track_seconds
+    bot.youtube_dl = SimpleNamespace(YoutubeDL=FakeYoutubeDL)
+
+    if shutil.which('ffmpeg') is None:
+        print("ffmpeg not found; streaming the WAV over HTTP without FFmpeg", file=sys.stderr)
+        bot._build_source = lambda audio_url, volume, acodec, start_at: bot.MeteredSource(
+            bot.make_volume_transformer(HttpPcmSource(audio_url), volume), 'pcm', start_at
+        )
+
+    results = asyncio.run(main(args, ports['status_ports']))
+    print_results(results)
+    print(f"Startup: bot import {import_seconds * 1000:.1f} ms, command tree hash {hash_seconds * 1000:.1f} ms")
+    if args.json:
+        with open(os.path.join(REPO_DIR, args.json), 'w') as f:
+            json.dump(results, f, indent=2)
+    fixtures.stdin.close()
+    fixtures.wait()
+    shutil.rmtree(workdir, ignore_errors=True)
@@ -5,89 +5,1980 @@ from dotenv import load_dotenv
 import aiohttp
 import os
 import asyncio
+import bisect
+import copy
 import json
-import yt_dlp as youtube_dl
-import requests
+import math
+import re
+import secrets
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import hashlib
+import itertools
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import urlparse, parse_qs
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
 import logging
 
-load_dotenv()
+# Counted from here so the startup log covers everything after the interpreter came up
+PROCESS_STARTED = time.monotonic()
+
+# yt-dlp and NumPy take a noticeable share of startup, so they load on first use
+youtube_dl = None
+np = None
+
+load_dotenv()
+
+# Define file names
+WHITELIST_FILE = 'whitelist.json'
+PUBLICP_FILE = 'publicp.json'
+SERVERS_FILE = 'servers.json'
+STATUS_CHANNEL_FILE = 'status_channel.json'
+STATUS_MESSAGES_FILE = 'status_messages.json'
+STREAM_CACHE_FILE = "stream_cache.json"
+TITLE_INDEX_FILE = "title_index.json"
+LOUDNESS_FILE = "loudness.json"
+SQLITE_FILE = os.getenv('SQLITE_FILE', 'musicbot.db')
+
+# 'json' keeps the global JSON files, 'sqlite' stores settings per guild
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')
+
+# Prometheus-style metrics endpoint; only served when a port is set
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+
+# Server status probing
+STATUS_PROBE_TIMEOUT = float(os.getenv('STATUS_PROBE_TIMEOUT', 5))
+STATUS_PROBE_CONCURRENCY = int(os.getenv('STATUS_PROBE_CONCURRENCY', 20))
+# Adaptive polling: a server is re-probed after STATUS_MIN_INTERVAL while its state is in
+# doubt, and the interval doubles while it stays up (to STATUS_MAX_INTERVAL) or stays
+# down (to STATUS_MAX_BACKOFF). STATUS_FLIP_AFTER agreeing probes are needed to change state.
+STATUS_MIN_INTERVAL = float(os.getenv('STATUS_MIN_INTERVAL', 10))
+STATUS_MAX_INTERVAL = float(os.getenv('STATUS_MAX_INTERVAL', 60))
+STATUS_MAX_BACKOFF = float(os.getenv('STATUS_MAX_BACKOFF', 300))
+STATUS_FLIP_AFTER = int(os.getenv('STATUS_FLIP_AFTER', 2))
+# Probe results kept per server for uptime and median latency
+STATUS_HISTORY = int(os.getenv('STATUS_HISTORY', 60))
+# Status messages are edited right away when a server changes state, but only this
+# often when just the uptime and latency figures moved
+STATUS_STATS_REFRESH = float(os.getenv('STATUS_STATS_REFRESH', 60))
+
+# Stream URL cache
+STREAM_CACHE_SIZE = int(os.getenv('STREAM_CACHE_SIZE', 256))
+STREAM_CACHE_PERSIST = os.getenv('STREAM_CACHE_PERSIST', '1') == '1'
+STREAM_CACHE_DEFAULT_TTL = 3 * 60 * 60
+# Treat entries as expired this many seconds before googlevideo does
+STREAM_CACHE_EXPIRY_MARGIN = 5 * 60
+
+# yt-dlp extraction workers ('thread' or 'process')
+EXTRACT_MODE = os.getenv('EXTRACT_MODE', 'thread')
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', 4))
+EXTRACT_MAX_PENDING = int(os.getenv('EXTRACT_MAX_PENDING', 32))
+EXTRACT_TIMEOUT = float(os.getenv('EXTRACT_TIMEOUT', 60))
+# Text search: flat results are enough to list and queue them
+SEARCH_OPTIONS = {'extract_flat': 'in_playlist', 'quiet': True}
+SEARCH_RESULTS = int(os.getenv('SEARCH_RESULTS', 5))
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', 256))
+SEARCH_CACHE_TTL = float(os.getenv('SEARCH_CACHE_TTL', 15 * 60))
+# Titles of played tracks and search results kept for local autocomplete matches
+TITLE_INDEX_SIZE = int(os.getenv('TITLE_INDEX_SIZE', 2000))
+# Autocomplete: wait this long for the user to stop typing before searching remotely,
+# and answer within the budget whatever has come back (Discord drops replies after 3 s)
+AUTOCOMPLETE_DEBOUNCE = float(os.getenv('AUTOCOMPLETE_DEBOUNCE', 0.4))
+AUTOCOMPLETE_BUDGET = float(os.getenv('AUTOCOMPLETE_BUDGET', 2.5))
+AUTOCOMPLETE_MIN_CHARS = int(os.getenv('AUTOCOMPLETE_MIN_CHARS', 3))
+AUTOCOMPLETE_CHOICES = int(os.getenv('AUTOCOMPLETE_CHOICES', 10))
+# Prefer Opus so playback can pass the stream through without re-encoding
+YDL_OPTIONS = {'format': 'bestaudio[acodec=opus]/bestaudio/best', 'noplaylist': True, 'quiet': True}
+
+# Playback queue
+QUEUE_MAX_LENGTH = int(os.getenv('QUEUE_MAX_LENGTH', 100))
+# Playlists are read with flat extraction (IDs and titles only) and expanded into the
+# queue this many tracks ahead of playback; stream URLs are resolved per track
+PLAYLIST_LOOKAHEAD = int(os.getenv('PLAYLIST_LOOKAHEAD', 3))
+PLAYLIST_MAX_TRACKS = int(os.getenv('PLAYLIST_MAX_TRACKS', 1000))
+PLAYLIST_OPTIONS = {'extract_flat': 'in_playlist', 'lazy_playlist': True, 'quiet': True}
+# Spawn the next track's FFmpeg this many seconds before the current one ends
+PREFETCH_LEAD = float(os.getenv('PREFETCH_LEAD', 15))
+FFMPEG_OPTIONS = {
+    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+    'options': '-vn'
+}
+# A track that stops more than STREAM_RESUME_MARGIN seconds short of its duration (or with
+# an error) is resumed from where it stopped, up to STREAM_RESUME_ATTEMPTS times per track
+STREAM_RESUME_MARGIN = float(os.getenv('STREAM_RESUME_MARGIN', 5))
+STREAM_RESUME_ATTEMPTS = int(os.getenv('STREAM_RESUME_ATTEMPTS', 3))
+# Loudness normalization: each video's integrated loudness is measured once in the
+# background with FFmpeg's loudnorm filter and cached, and later plays are scaled toward
+# LOUDNESS_TARGET LUFS through the normal volume path. Boosts are capped at
+# LOUDNESS_MAX_BOOST dB and kept below -1 dBTP.
+LOUDNESS_NORMALIZE = os.getenv('LOUDNESS_NORMALIZE', '0') == '1'
+LOUDNESS_TARGET = float(os.getenv('LOUDNESS_TARGET', -14))
+LOUDNESS_MAX_BOOST = float(os.getenv('LOUDNESS_MAX_BOOST', 6))
+LOUDNESS_CACHE_SIZE = int(os.getenv('LOUDNESS_CACHE_SIZE', 5000))
+# Only the first this many seconds of a track are analysed
+LOUDNESS_ANALYZE_SECONDS = int(os.getenv('LOUDNESS_ANALYZE_SECONDS', 600))
+LOUDNESS_ANALYZE_TIMEOUT = float(os.getenv('LOUDNESS_ANALYZE_TIMEOUT', 180))
+LOUDNESS_CONCURRENCY = int(os.getenv('LOUDNESS_CONCURRENCY', 1))
+# 'auto' copies Opus streams straight through when volume is 100%, 'pcm' always decodes
+PLAYBACK_MODE = os.getenv('PLAYBACK_MODE', 'auto')
+# 'numpy' scales PCM with NumPy, 'ffmpeg' bakes a fixed gain into FFmpeg's filter graph,
+# 'audioop' keeps discord.PCMVolumeTransformer
+VOLUME_MODE = os.getenv('VOLUME_MODE', 'numpy')
+# Frames read and scaled per NumPy call
+VOLUME_BATCH_FRAMES = int(os.getenv('VOLUME_BATCH_FRAMES', 1))
+
+# Captured Opus frames for Loop/Replay: kept in memory up to the per-guild budget,
+# spilled to a temp file beyond it, and dropped entirely past the max size
+LOOP_BUFFER_MEMORY = int(os.getenv('LOOP_BUFFER_MEMORY', 8 * 1024 * 1024))
+LOOP_BUFFER_MAX_BYTES = int(os.getenv('LOOP_BUFFER_MAX_BYTES', 64 * 1024 * 1024))
+
+# Idle disconnect: seconds the bot may sit alone in a voice channel (0 disables)
+IDLE_TIMEOUT = float(os.getenv('IDLE_TIMEOUT', 60))
+
+# In-memory config: debounce for writes and how often to look for external edits
+CONFIG_SAVE_DELAY = float(os.getenv('CONFIG_SAVE_DELAY', 1.0))
+CONFIG_RELOAD_INTERVAL = float(os.getenv('CONFIG_RELOAD_INTERVAL', 2.0))
+
+# Cluster mode: with CLUSTER_WORKERS > 1, `python bot.py` starts a coordinator that owns
+# the config, the stream cache and extraction, and status probing, then runs that many
+# worker processes, each an AutoShardedBot for its share of the shards. Workers reach
+# the coordinator over a localhost socket.
+CLUSTER_WORKERS = int(os.getenv('CLUSTER_WORKERS', 1))
+CLUSTER_PORT = int(os.getenv('CLUSTER_PORT', 47600))
+# 0 uses Discord's recommended shard count (at least one shard per worker)
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0))
+# Set by the coordinator in each worker's environment
+CLUSTER_WORKER_ID = os.getenv('CLUSTER_WORKER_ID')
+CLUSTER_TOKEN = os.getenv('CLUSTER_TOKEN')
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id]
+
+# Hash of the last command tree synced to Discord, so restarts skip an unchanged sync
+COMMAND_SYNC_FILE = os.getenv('COMMAND_SYNC_FILE', 'command_sync.json')
+
+def write_atomic(file, text):
+    """Write through a temp file and rename it over `file`, so a crash never leaves half a file."""
+    directory = os.path.dirname(os.path.abspath(file))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(file)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def save_json(file, data):
+    write_atomic(file, json.dumps(data))
+
+class DebouncedWriter:
+    """
+    Saves a JSON file at most once per `delay` seconds, atomically and from a worker thread.
+    `snapshot` is called on the event loop and must return data that later changes won't
+    touch. Without a running loop (startup, scripts) every change is written right away.
+    """
+    def __init__(self, path, snapshot, delay=5.0, on_write=None):
+        self.path = path
+        self.snapshot = snapshot
+        self.delay = delay
+        self.on_write = on_write
+        self.seq = 0
+        self.written_seq = 0
+        self.handle = None
+        self.lock = threading.Lock()
+
+    @property
+    def pending(self):
+        """Whether there are changes not written to disk yet."""
+        return self.seq != self.written_seq
+
+    def schedule(self):
+        self.seq += 1
+        if self.handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(self.seq, self.snapshot())
+            return
+        self.handle = loop.call_later(self.delay, self._flush, loop)
+
+    def _flush(self, loop):
+        self.handle = None
+        loop.run_in_executor(None, self._write, self.seq, self.snapshot())
+
+    def _write(self, seq, data):
+        with self.lock:
+            # An older snapshot must never overwrite a newer one
+            if seq <= self.written_seq:
+                return
+            save_json(self.path, data)
+            if self.on_write:
+                self.on_write()
+            self.written_seq = seq
+
+    def flush(self):
+        """Write pending changes right away (used on shutdown)."""
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.pending:
+            self._write(self.seq, self.snapshot())
+
+def load_json(file):
+    if os.path.exists(file):
+        with open(file, 'r') as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                return {}
+    return {}
+
+CONFIG_DEFAULTS = {
+    WHITELIST_FILE: {'whitelisted_users': []},
+    PUBLICP_FILE: {},
+    SERVERS_FILE: {'servers': {}},
+    STATUS_CHANNEL_FILE: {'channel_id': None},
+    STATUS_MESSAGES_FILE: {'messages': {}},
+}
+
+# Initialize JSON files if they don't exist
+def initialize_json_files():
+    files_defaults = dict(CONFIG_DEFAULTS)
+    files_defaults[STREAM_CACHE_FILE] = {}
+    for file, default in files_defaults.items():
+        if not os.path.exists(file):
+            save_json(file, default)
+
+initialize_json_files()
+
+class ConfigFile:
+    """
+    A JSON config file held in memory.
+    Reads never touch the disk except for a periodic mtime check that picks up
+    external edits; writes are debounced and written atomically from a worker thread.
+    The returned data is shared, so callers that change it must pass it back to set().
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        self.version = 0
+        self.mtime = None
+        self.checked_at = 0.0
+        # Callers change the data in place, so the writer gets its own copy
+        self.writer = DebouncedWriter(path, lambda: copy.deepcopy(self.data), CONFIG_SAVE_DELAY, self._written)
+        self._derived = None
+        self._derived_version = None
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _reload(self):
+        self.mtime = self._stat()
+        self.checked_at = time.monotonic()
+        self.data = load_json(self.path)
+        self.version += 1
+
+    def get(self):
+        if self.data is None:
+            self._reload()
+        elif not self.writer.pending and time.monotonic() - self.checked_at >= CONFIG_RELOAD_INTERVAL:
+            # Only look for external edits while none of ours are waiting to be written
+            self.checked_at = time.monotonic()
+            if self._stat() != self.mtime:
+                logging.info(f"{self.path} changed on disk, reloading")
+                self._reload()
+        return self.data
+
+    def derived(self, build):
+        """Cache a value computed from the data until the data changes."""
+        data = self.get()
+        if self._derived_version != self.version:
+            self._derived = build(data)
+            self._derived_version = self.version
+        return self._derived
+
+    def set(self, data):
+        self.data = data
+        self.version += 1
+        self.writer.schedule()
+
+    def _written(self):
+        # Our own write isn't an external edit
+        self.mtime = self._stat()
+
+    def flush(self):
+        """Write pending changes right away (used on shutdown)."""
+        self.writer.flush()
+
+config_files = {file: ConfigFile(file) for file in CONFIG_DEFAULTS}
+
+def load_whitelist():
+    return config_files[WHITELIST_FILE].derived(lambda data: frozenset(data.get('whitelisted_users', [])))
+
+def save_whitelist(whitelisted_users):
+    config_files[WHITELIST_FILE].set({'whitelisted_users': sorted(whitelisted_users)})
+
+def load_publicp():
+    return config_files[PUBLICP_FILE].get()
+
+def save_publicp(publicp):
+    config_files[PUBLICP_FILE].set(publicp)
+
+def load_servers():
+    return config_files[SERVERS_FILE].get().get('servers', {})
+
+def save_servers(servers):
+    config_files[SERVERS_FILE].set({'servers': servers})
+
+def load_status_channel():
+    return config_files[STATUS_CHANNEL_FILE].get().get('channel_id', None)
+
+def save_status_channel(channel_id):
+    config_files[STATUS_CHANNEL_FILE].set({'channel_id': channel_id})
+
+def load_status_messages():
+    return config_files[STATUS_MESSAGES_FILE].get().get('messages', {})
+
+def save_status_messages(messages):
+    config_files[STATUS_MESSAGES_FILE].set({'messages': messages})
+
+class JsonStorage:
+    """
+    Settings backed by the global JSON files.
+    Every guild shares the same channels, whitelist and servers, so guild_id is ignored.
+    """
+    async def get_channels(self, guild_id):
+        publicp = load_publicp()
+        return {'text_channel_id': publicp.get('text_channel_id'), 'voice_channel_id': publicp.get('voice_channel_id')}
+
+    async def set_channel(self, guild_id, kind, channel_id):
+        publicp = load_publicp()
+        if channel_id is None:
+            publicp.pop(kind, None)
+        else:
+            publicp[kind] = channel_id
+        save_publicp(publicp)
+
+    async def is_whitelisted(self, guild_id, *user_ids):
+        whitelisted_users = load_whitelist()
+        return any(user_id in whitelisted_users for user_id in user_ids)
+
+    async def add_whitelist(self, guild_id, user_id):
+        whitelisted_users = load_whitelist()
+        if user_id in whitelisted_users:
+            return False
+        save_whitelist(whitelisted_users | {user_id})
+        return True
+
+    async def get_servers(self, guild_id):
+        return load_servers()
+
+    async def add_server(self, guild_id, name, ip, port):
+        servers = load_servers()
+        servers[name] = {'ip': ip, 'port': port}
+        save_servers(servers)
+
+    async def remove_server(self, guild_id, name):
+        servers = load_servers()
+        if name not in servers:
+            return False
+        del servers[name]
+        save_servers(servers)
+        return True
+
+    async def set_status_channel(self, guild_id, channel_id):
+        save_status_channel(channel_id)
+
+    async def status_targets(self):
+        """Every status channel to keep updated, with its message ID and servers."""
+        return [{
+            'guild_id': None,
+            'channel_id': load_status_channel(),
+            'message_id': load_status_messages().get('status_message_id'),
+            'servers': load_servers(),
+        }]
+
+    async def set_status_message(self, guild_id, message_id):
+        status_messages = load_status_messages()
+        status_messages['status_message_id'] = message_id
+        save_status_messages(status_messages)
+
+    async def close(self):
+        pass
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS whitelist (
+    guild_id INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS guild_settings (
+    guild_id INTEGER PRIMARY KEY,
+    text_channel_id TEXT,
+    voice_channel_id TEXT,
+    status_channel_id TEXT,
+    status_message_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS guild_settings_status ON guild_settings (status_channel_id)
+    WHERE status_channel_id IS NOT NULL;
+CREATE TABLE IF NOT EXISTS servers (
+    guild_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    ip TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, name)
+) WITHOUT ROWID;
+"""
+
+# Whitelist entries under this guild ID apply to every guild (imported from whitelist.json)
+GLOBAL_GUILD_ID = 0
+
+class SqliteStorage:
+    """
+    Per-guild settings in SQLite (WAL mode), with the same interface as JsonStorage.
+    One dedicated thread owns the connection and runs every query, so the
+    event loop never waits on disk.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self.conn = None
+
+    def _connection(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.executescript(SQLITE_SCHEMA)
+        return self.conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _query(self, sql, params=()):
+        return self._connection().execute(sql, params).fetchall()
+
+    def _execute(self, sql, params=()):
+        conn = self._connection()
+        with conn:
+            return conn.execute(sql, params).rowcount
+
+    async def get_channels(self, guild_id):
+        rows = await self._run(
+            self._query,
+            'SELECT text_channel_id, voice_channel_id FROM guild_settings WHERE guild_id = ?',
+            (guild_id,)
+        )
+        text_channel_id, voice_channel_id = rows[0] if rows else (None, None)
+        return {'text_channel_id': text_channel_id, 'voice_channel_id': voice_channel_id}
+
+    async def set_channel(self, guild_id, kind, channel_id):
+        if kind not in ('text_channel_id', 'voice_channel_id'):
+            raise ValueError(f"Unknown channel kind: {kind}")
+        await self._run(
+            self._execute,
+            f'INSERT INTO guild_settings (guild_id, {kind}) VALUES (?, ?) '
+            f'ON CONFLICT (guild_id) DO UPDATE SET {kind} = excluded.{kind}',
+            (guild_id, channel_id)
+        )
+
+    async def is_whitelisted(self, guild_id, *user_ids):
+        placeholders = ', '.join('?' * len(user_ids))
+        rows = await self._run(
+            self._query,
+            f'SELECT 1 FROM whitelist WHERE guild_id IN (?, ?) AND user_id IN ({placeholders}) LIMIT 1',
+            (guild_id, GLOBAL_GUILD_ID, *user_ids)
+        )
+        return bool(rows)
+
+    async def add_whitelist(self, guild_id, user_id):
+        added = await self._run(
+            self._execute,
+            'INSERT OR IGNORE INTO whitelist (guild_id, user_id) VALUES (?, ?)',
+            (guild_id, user_id)
+        )
+        return added > 0
+
+    async def get_servers(self, guild_id):
+        rows = await self._run(
+            self._query, 'SELECT name, ip, port FROM servers WHERE guild_id = ? ORDER BY name', (guild_id,)
+        )
+        return {name: {'ip': ip, 'port': port} for name, ip, port in rows}
+
+    async def add_server(self, guild_id, name, ip, port):
+        await self._run(
+            self._execute,
+            'INSERT OR REPLACE INTO servers (guild_id, name, ip, port) VALUES (?, ?, ?, ?)',
+            (guild_id, name, ip, port)
+        )
+
+    async def remove_server(self, guild_id, name):
+        removed = await self._run(
+            self._execute, 'DELETE FROM servers WHERE guild_id = ? AND name = ?', (guild_id, name)
+        )
+        return removed > 0
+
+    async def set_status_channel(self, guild_id, channel_id):
+        await self._run(
+            self._execute,
+            'INSERT INTO guild_settings (guild_id, status_channel_id) VALUES (?, ?) '
+            'ON CONFLICT (guild_id) DO UPDATE SET status_channel_id = excluded.status_channel_id, '
+            'status_message_id = NULL',
+            (guild_id, channel_id)
+        )
+
+    def _status_targets(self):
+        targets = {}
+        for guild_id, channel_id, message_id in self._query(
+            'SELECT guild_id, status_channel_id, status_message_id FROM guild_settings '
+            'WHERE status_channel_id IS NOT NULL'
+        ):
+            targets[guild_id] = {'guild_id': guild_id, 'channel_id': channel_id, 'message_id': message_id, 'servers': {}}
+        for guild_id, name, ip, port in self._query(
+            'SELECT s.guild_id, s.name, s.ip, s.port FROM servers s '
+            'JOIN guild_settings g ON g.guild_id = s.guild_id WHERE g.status_channel_id IS NOT NULL '
+            'ORDER BY s.guild_id, s.name'
+        ):
+            targets[guild_id]['servers'][name] = {'ip': ip, 'port': port}
+        return list(targets.values())
+
+    async def status_targets(self):
+        return await self._run(self._status_targets)
+
+    async def set_status_message(self, guild_id, message_id):
+        await self._run(
+            self._execute,
+            'UPDATE guild_settings SET status_message_id = ? WHERE guild_id = ?',
+            (message_id, guild_id)
+        )
+
+    def _migrate_json(self, channel_guilds, snapshot):
+        conn = self._connection()
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+            return False
+
+        def guild_for(channel_id):
+            guild_id = channel_guilds.get(str(channel_id)) if channel_id else None
+            if channel_id and guild_id is None:
+                logging.warning(f"Could not find the guild of channel {channel_id}; it was not migrated")
+            return guild_id
+
+        with conn:
+            for user_id in snapshot['whitelist']:
+                conn.execute('INSERT OR IGNORE INTO whitelist VALUES (?, ?)', (GLOBAL_GUILD_ID, user_id))
+            publicp = snapshot['publicp']
+            for kind in ('text_channel_id', 'voice_channel_id'):
+                guild_id = guild_for(publicp.get(kind))
+                if guild_id is not None:
+                    conn.execute(
+                        f'INSERT INTO guild_settings (guild_id, {kind}) VALUES (?, ?) '
+                        f'ON CONFLICT (guild_id) DO UPDATE SET {kind} = excluded.{kind}',
+                        (guild_id, publicp[kind])
+                    )
+            status_channel_id = snapshot['status_channel_id']
+            status_guild_id = guild_for(status_channel_id)
+            if status_guild_id is not None:
+                conn.execute(
+                    'INSERT INTO guild_settings (guild_id, status_channel_id, status_message_id) VALUES (?, ?, ?) '
+                    'ON CONFLICT (guild_id) DO UPDATE SET status_channel_id = excluded.status_channel_id, '
+                    'status_message_id = excluded.status_message_id',
+                    (status_guild_id, status_channel_id, snapshot['status_message_id'])
+                )
+                for name, info in snapshot['servers'].items():
+                    conn.execute(
+                        'INSERT OR REPLACE INTO servers VALUES (?, ?, ?, ?)',
+                        (status_guild_id, name, info['ip'], info['port'])
+                    )
+            conn.execute("INSERT INTO meta VALUES ('json_migrated', ?)", (str(int(time.time())),))
+        return True
+
+    async def migrate_json(self, channel_guilds):
+        """
+        Import the global JSON files once. Channels are assigned to the guild that owns
+        them (`channel_guilds` maps channel ID -> guild ID); the whitelist stays global.
+        """
+        # Read the JSON side here, on the event loop, where ConfigFile lives
+        snapshot = {
+            'whitelist': list(load_whitelist()),
+            'publicp': dict(load_publicp()),
+            'status_channel_id': load_status_channel(),
+            'status_message_id': load_status_messages().get('status_message_id'),
+            'servers': dict(load_servers()),
+        }
+        if await self._run(self._migrate_json, channel_guilds, snapshot):
+            logging.info("Imported JSON settings into SQLite")
+
+    async def close(self):
+        def _close():
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+        await self._run(_close)
+        self.executor.shutdown(wait=True)
+
+class ClusterError(Exception):
+    pass
+
+class ClusterClient:
+    """
+    A worker's connection to the cluster coordinator.
+    Requests and replies are JSON lines matched up by ID, so any number can be in flight.
+    """
+    def __init__(self, port, token):
+        self.port = port
+        self.token = token
+        self.writer = None
+        self.reader_task = None
+        self.pending = {}
+        self.next_id = 0
+        # Created on first use, since before Python 3.10 it binds to the loop current at creation
+        self.connect_lock = None
+
+    async def connect(self):
+        if self.connect_lock is None:
+            self.connect_lock = asyncio.Lock()
+        async with self.connect_lock:
+            if self.writer is not None:
+                return
+            reader, writer = await asyncio.open_connection('127.0.0.1', self.port, limit=2 ** 22)
+            writer.write((json.dumps({'token': self.token}) + "\n").encode())
+            await writer.drain()
+            self.writer = writer
+            self.reader_task = asyncio.ensure_future(self._read_replies(reader))
+
+    async def _read_replies(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = json.loads(line)
+                future = self.pending.pop(reply['id'], None)
+                if future is None or future.done():
+                    continue
+                if 'error' in reply:
+                    future.set_exception(ClusterError(reply['error']))
+                else:
+                    future.set_result(reply['result'])
+        finally:
+            self.writer = None
+            pending, self.pending = self.pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ClusterError("Lost the connection to the coordinator"))
+
+    async def request(self, op, *args):
+        try:
+            await self.connect()
+        except OSError as e:
+            raise ClusterError(f"Coordinator unreachable: {e}") from e
+        writer = self.writer
+        if writer is None:
+            raise ClusterError("Lost the connection to the coordinator")
+        self.next_id += 1
+        request_id = self.next_id
+        future = self.pending[request_id] = asyncio.get_running_loop().create_future()
+        try:
+            writer.write((json.dumps({'id': request_id, 'op': op, 'args': args}) + "\n").encode())
+            await writer.drain()
+            return await future
+        except OSError as e:
+            raise ClusterError(f"Lost the connection to the coordinator: {e}") from e
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.reader_task is not None:
+            await asyncio.gather(self.reader_task, return_exceptions=True)
+
+class RemoteStorage:
+    """The storage API of a cluster worker, answered by the coordinator's storage."""
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    async def _call(self, method, *args):
+        return await self.cluster.request('storage', method, *args)
+
+    async def get_channels(self, guild_id):
+        return await self._call('get_channels', guild_id)
+
+    async def set_channel(self, guild_id, kind, channel_id):
+        await self._call('set_channel', guild_id, kind, channel_id)
+
+    async def is_whitelisted(self, guild_id, *user_ids):
+        return await self._call('is_whitelisted', guild_id, *user_ids)
+
+    async def add_whitelist(self, guild_id, user_id):
+        return await self._call('add_whitelist', guild_id, user_id)
+
+    async def get_servers(self, guild_id):
+        return await self._call('get_servers', guild_id)
+
+    async def add_server(self, guild_id, name, ip, port):
+        await self._call('add_server', guild_id, name, ip, port)
+
+    async def remove_server(self, guild_id, name):
+        return await self._call('remove_server', guild_id, name)
+
+    async def set_status_channel(self, guild_id, channel_id):
+        await self._call('set_status_channel', guild_id, channel_id)
+
+    async def status_targets(self):
+        return await self._call('status_targets')
+
+    async def set_status_message(self, guild_id, message_id):
+        await self._call('set_status_message', guild_id, message_id)
+
+    async def close(self):
+        await self.cluster.close()
+
+# Storage methods a worker may call on the coordinator
+REMOTE_STORAGE_METHODS = {
+    'get_channels', 'set_channel', 'is_whitelisted', 'add_whitelist', 'get_servers', 'add_server',
+    'remove_server', 'set_status_channel', 'status_targets', 'set_status_message',
+}
+
+cluster = ClusterClient(CLUSTER_PORT, CLUSTER_TOKEN) if CLUSTER_WORKER_ID is not None else None
+
+if cluster is not None:
+    storage = RemoteStorage(cluster)
+elif STORAGE_BACKEND == 'sqlite':
+    storage = SqliteStorage(SQLITE_FILE)
+else:
+    storage = JsonStorage()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    """Fixed-bucket latency histogram; cheap enough to observe on every call."""
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        # Observed from voice player threads as well as the event loop
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th quantile, or None without samples."""
+        with self.lock:
+            counts, total = list(self.counts), self.count
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render(self):
+        with self.lock:
+            counts, total, value_sum = list(self.counts), self.count, self.sum
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {total}')
+        lines.append(f"{self.name}_sum {value_sum}")
+        lines.append(f"{self.name}_count {total}")
+        return lines
+
+class Counter:
+    def __init__(self, name, description, read=None):
+        self.name = name
+        self.description = description
+        # Counters owned elsewhere (e.g. the stream cache) are read through a callback
+        self.read = read
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def get(self):
+        return self.read() if self.read else self.value
+
+    def render(self):
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter", f"{self.name} {self.get()}"]
+
+class Gauge(Counter):
+    def render(self):
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge", f"{self.name} {self.get()}"]
+
+class Metrics:
+    def __init__(self):
+        self.playbot = Histogram('musicbot_playbot_seconds', 'Time from /playbot to the now-playing reply')
+        self.time_to_first_audio = Histogram(
+            'musicbot_time_to_first_audio_seconds', 'Time from /playbot to the first audio frame sent')
+        self.track_transition = Histogram(
+            'musicbot_track_transition_seconds', 'Time from advancing the queue to the next track\'s first frame')
+        self.play_audio = Histogram('musicbot_play_audio_seconds', 'Time spent in play_audio before playback starts')
+        self.extraction = Histogram('musicbot_extraction_seconds', 'yt-dlp extraction latency')
+        self.ffmpeg_spawn = Histogram('musicbot_ffmpeg_spawn_seconds', 'Time to spawn an FFmpeg source')
+        self.status_probe = Histogram('musicbot_status_probe_seconds', 'Server status probe latency')
+        self.extraction_errors = Counter('musicbot_extraction_errors_total', 'Failed yt-dlp extractions')
+        self.ffmpeg_spawns = Counter('musicbot_ffmpeg_spawns_total', 'FFmpeg processes started')
+        self.ffmpeg_restarts = Counter('musicbot_ffmpeg_restarts_total', 'Streams restarted mid-track')
+        self.stream_resumes = Counter(
+            'musicbot_stream_resumes_total', 'Tracks resumed at their last position after the stream dropped')
+        self.playback_errors = Counter('musicbot_playback_errors_total', 'Errors reported by the voice player')
+        self.probe_failures = Counter('musicbot_status_probe_failures_total', 'Failed server status probes')
+        self.probes_skipped = Counter(
+            'musicbot_status_probes_skipped_total', 'Status probes skipped because the server was not due yet')
+        self.cache_hits = Counter('musicbot_stream_cache_hits_total', 'Stream cache hits', lambda: stream_cache.hits)
+        self.cache_misses = Counter(
+            'musicbot_stream_cache_misses_total', 'Stream cache misses', lambda: stream_cache.misses)
+        self.voice_clients = Gauge('musicbot_voice_clients', 'Connected voice clients', lambda: len(client.voice_clients))
+        self.active_streams = Gauge(
+            'musicbot_active_streams', 'Voice clients currently playing',
+            lambda: sum(1 for voice_client in client.voice_clients if voice_client.is_playing()))
+        self.extractions_inflight = Gauge(
+            'musicbot_extractions_inflight', 'Distinct extractions in progress', lambda: len(extraction_service.inflight))
+        self.startup = Gauge(
+            'musicbot_startup_seconds', 'Time from process start to the first ready event', lambda: startup_seconds or 0)
+        self.reconnect = Histogram('musicbot_reconnect_seconds', 'Time from a gateway disconnect to ready again')
+        self.autocomplete = Histogram('musicbot_autocomplete_seconds', 'Time to answer a /playbot autocomplete request')
+        self.searches = Counter('musicbot_searches_total', 'Text searches sent to yt-dlp (search cache misses)')
+
+    def all(self):
+        return [value for value in vars(self).values() if isinstance(value, (Histogram, Counter))]
+
+    def render(self):
+        lines = []
+        for metric in self.all():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+metrics_runner = None
+
+async def start_metrics_server():
+    global metrics_runner
+    if not METRICS_PORT:
+        return
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    metrics_runner = web.AppRunner(app, access_log=None)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def stop_metrics_server():
+    global metrics_runner
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+
+YOUTUBE_ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+def extract_video_id(url):
+    """
+    Normalize a YouTube link to its 11 character video ID.
+    Falls back to the stripped URL for anything we can't parse.
+    """
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or '').lower()
+    video_id = None
+    if host.endswith('youtu.be'):
+        video_id = parsed.path.lstrip('/').split('/')[0]
+    elif host.endswith('youtube.com'):
+        if parsed.path == '/watch':
+            video_id = parse_qs(parsed.query).get('v', [None])[0]
+        else:
+            parts = parsed.path.strip('/').split('/')
+            if len(parts) >= 2 and parts[0] in ('shorts', 'embed', 'live', 'v'):
+                video_id = parts[1]
+    if video_id and YOUTUBE_ID_RE.match(video_id):
+        return video_id
+    return url.strip()
+
+def watch_url(video_id):
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+def extract_playlist_id(url):
+    """The list ID of a youtube.com/playlist link, or None for anything else."""
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or '').lower()
+    if host.endswith('youtube.com') and parsed.path == '/playlist':
+        return parse_qs(parsed.query).get('list', [None])[0]
+    return None
+
+def stream_url_expiry(audio_url):
+    """Read the expiry timestamp googlevideo signs into its stream URLs."""
+    match = re.search(r'[?&/]expire[=/](\d+)', audio_url)
+    if match:
+        return int(match.group(1))
+    return time.time() + STREAM_CACHE_DEFAULT_TTL
+
+class StreamCache:
+    """
+    Bounded LRU cache of resolved stream URLs keyed by video ID, shared by all guilds.
+    Entries expire with their googlevideo signature and are optionally persisted to disk.
+    """
+    def __init__(self, file, max_entries=STREAM_CACHE_SIZE, persist=STREAM_CACHE_PERSIST):
+        self.file = file
+        self.max_entries = max_entries
+        self.persist = persist
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.writer = DebouncedWriter(file, lambda: dict(self.entries))
+        if self.persist:
+            self.load()
+
+    def load(self):
+        now = time.time()
+        for video_id, entry in load_json(self.file).items():
+            if isinstance(entry, dict) and entry.get('expires', 0) - STREAM_CACHE_EXPIRY_MARGIN > now:
+                self.entries[video_id] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def peek(self, video_id):
+        """Look up an entry without touching recency or the hit counters."""
+        return self.entries.get(video_id)
+
+    def get(self, video_id):
+        entry = self.entries.get(video_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry['expires'] - STREAM_CACHE_EXPIRY_MARGIN <= time.time():
+            del self.entries[video_id]
+            self.misses += 1
+            self.schedule_save()
+            return None
+        self.entries.move_to_end(video_id)
+        self.hits += 1
+        return entry
+
+    def put(self, video_id, audio_url, **extra):
+        entry = {'audio_url': audio_url, 'expires': stream_url_expiry(audio_url), **extra}
+        self.entries[video_id] = entry
+        self.entries.move_to_end(video_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.schedule_save()
+        return entry
+
+    def invalidate(self, video_id):
+        if self.entries.pop(video_id, None) is not None:
+            self.schedule_save()
+
+    def schedule_save(self):
+        """Coalesce writes and flush them from a worker thread shortly after."""
+        if self.persist:
+            self.writer.schedule()
+
+    def flush(self):
+        """Write any pending changes right away (used on shutdown)."""
+        self.writer.flush()
+
+    def stats(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0.0
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'hit_ratio': ratio}
+
+# In cluster mode the coordinator's copies are the ones written to disk
+stream_cache = StreamCache(STREAM_CACHE_FILE, persist=STREAM_CACHE_PERSIST and cluster is None)
+
+def normalize_title(text):
+    return re.sub(r'[\W_]+', ' ', text.lower()).strip()
+
+class TitleIndex:
+    """
+    Prefix index over known track titles for autocomplete.
+    Every word of a title starts a key, so "never gonna" finds "Rick Astley - Never Gonna
+    Give You Up". Keys live in a sorted list, so a lookup is a bisect plus a short scan.
+    """
+    def __init__(self, file, max_entries=TITLE_INDEX_SIZE, persist=STREAM_CACHE_PERSIST):
+        self.file = file
+        self.max_entries = max_entries
+        self.persist = persist
+        self.titles = OrderedDict()
+        self.keys = []
+        self.writer = DebouncedWriter(file, lambda: dict(self.titles))
+        if self.persist:
+            for url, title in load_json(self.file).items():
+                if isinstance(title, str):
+                    self.add(title, url, save=False)
+
+    @staticmethod
+    def _keys(title, url):
+        words = normalize_title(title).split()
+        return {(' '.join(words[i:]), url) for i in range(len(words))}
+
+    def add(self, title, url, save=True):
+        if not title:
+            return
+        if url in self.titles:
+            self.titles.move_to_end(url)
+            if self.titles[url] == title:
+                return
+            self._remove(url)
+        self.titles[url] = title
+        for key in self._keys(title, url):
+            bisect.insort(self.keys, key)
+        while len(self.titles) > self.max_entries:
+            self._remove(next(iter(self.titles)))
+        if save:
+            self.schedule_save()
+
+    def _remove(self, url):
+        title = self.titles.pop(url)
+        for key in self._keys(title, url):
+            index = bisect.bisect_left(self.keys, key)
+            if index < len(self.keys) and self.keys[index] == key:
+                del self.keys[index]
+
+    def search(self, query, limit):
+        """Up to `limit` (title, url) pairs whose title has a word starting with `query`."""
+        prefix = normalize_title(query)
+        if not prefix:
+            return []
+        found = []
+        index = bisect.bisect_left(self.keys, (prefix,))
+        while index < len(self.keys) and len(found) < limit:
+            key, url = self.keys[index]
+            if not key.startswith(prefix):
+                break
+            if url not in found:
+                found.append(url)
+            index += 1
+        return [(self.titles[url], url) for url in found]
+
+    def schedule_save(self):
+        if self.persist:
+            self.writer.schedule()
+
+    def flush(self):
+        self.writer.flush()
+
+title_index = TitleIndex(TITLE_INDEX_FILE, persist=STREAM_CACHE_PERSIST and cluster is None)
+
+class SearchCache:
+    """Recent search results by normalized query, dropped after `ttl` seconds."""
+    def __init__(self, max_entries=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, query):
+        entry = self.entries.get(query)
+        if entry is None:
+            return None
+        expires, results = entry
+        if expires <= time.monotonic():
+            del self.entries[query]
+            return None
+        self.entries.move_to_end(query)
+        return results
+
+    def put(self, query, results):
+        self.entries[query] = (time.monotonic() + self.ttl, results)
+        self.entries.move_to_end(query)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+search_cache = SearchCache()
+
+class LoudnessCache:
+    """
+    Measured loudness per video ID ({'lufs', 'peak'}), LRU-bounded and persisted.
+    The gain is worked out from the measurement on lookup, so changing the target
+    doesn't require measuring again.
+    """
+    def __init__(self, file, max_entries=LOUDNESS_CACHE_SIZE, persist=True):
+        self.file = file
+        self.max_entries = max_entries
+        self.persist = persist
+        self.entries = OrderedDict()
+        self.writer = DebouncedWriter(file, lambda: dict(self.entries))
+        if self.persist:
+            for video_id, entry in load_json(self.file).items():
+                if isinstance(entry, dict) and 'lufs' in entry and 'peak' in entry:
+                    self.entries[video_id] = entry
+
+    def peek(self, video_id):
+        return self.entries.get(video_id)
+
+    def gain(self, video_id):
+        """Linear gain that brings the video to LOUDNESS_TARGET, or 1.0 when unmeasured."""
+        if not LOUDNESS_NORMALIZE:
+            return 1.0
+        entry = self.entries.get(video_id)
+        if entry is None:
+            return 1.0
+        self.entries.move_to_end(video_id)
+        gain_db = min(LOUDNESS_TARGET - entry['lufs'], LOUDNESS_MAX_BOOST, -1.0 - entry['peak'])
+        # Close enough to leave alone, which keeps Opus passthrough possible
+        if abs(gain_db) < 0.5:
+            return 1.0
+        return 10 ** (gain_db / 20)
+
+    def put(self, video_id, entry):
+        self.entries[video_id] = entry
+        self.entries.move_to_end(video_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.schedule_save()
+
+    def schedule_save(self):
+        if self.persist:
+            self.writer.schedule()
+
+    def flush(self):
+        self.writer.flush()
+
+loudness_cache = LoudnessCache(LOUDNESS_FILE, persist=cluster is None)
+
+class ExtractionQueueFull(Exception):
+    pass
+
+# Only these fields leave the worker, so process mode doesn't pickle whole info dicts
+INFO_FIELDS = ('id', 'title', 'url', 'webpage_url', 'duration', 'acodec', 'ext', 'abr', 'asr', 'http_headers')
+
+_ydl_local = threading.local()
+_import_lock = threading.Lock()
+
+def load_youtube_dl():
+    """Import yt-dlp the first time it's needed; safe to call from any worker."""
+    global youtube_dl
+    if youtube_dl is None:
+        with _import_lock:
+            if youtube_dl is None:
+                import yt_dlp
+                youtube_dl = yt_dlp
+    return youtube_dl
+
+def _extract_worker(url, opts):
+    """
+    Runs inside an extraction worker thread or process.
+    Each worker keeps its own YoutubeDL per option set, since instances aren't thread-safe.
+    """
+    instances = getattr(_ydl_local, 'instances', None)
+    if instances is None:
+        instances = _ydl_local.instances = {}
+    key = json.dumps(opts, sort_keys=True)
+    ydl = instances.get(key)
+    if ydl is None:
+        ydl = instances[key] = load_youtube_dl().YoutubeDL(opts)
+    info = ydl.extract_info(url, download=False)
+    result = {field: info.get(field) for field in INFO_FIELDS}
+    if info.get('entries') is not None:
+        # Flat search results: just enough to list and queue them
+        result['entries'] = [
+            {field: entry.get(field) for field in ('id', 'title', 'duration')} for entry in info['entries']
+        ]
+    return result
+
+class ExtractionService:
+    """
+    Bounded pool for yt-dlp extractions.
+    Concurrent requests for the same key share one in-flight extraction, and the
+    extraction is cancelled once every caller waiting on it has gone away.
+    """
+    def __init__(self, workers=EXTRACT_WORKERS, mode=EXTRACT_MODE, max_pending=EXTRACT_MAX_PENDING):
+        self.workers = workers
+        self.mode = mode
+        self.max_pending = max_pending
+        self.executor = None
+        self.inflight = {}
+
+    def _get_executor(self):
+        if self.executor is None:
+            if self.mode == 'process':
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='yt-dlp')
+        return self.executor
+
+    async def extract(self, url, key=None, opts=None):
+        opts = opts or YDL_OPTIONS
+        inflight_key = (key or url, json.dumps(opts, sort_keys=True))
+        entry = self.inflight.get(inflight_key)
+        if entry is None:
+            if len(self.inflight) >= self.max_pending:
+                raise ExtractionQueueFull(f"{len(self.inflight)} extractions already pending")
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._get_executor(), _extract_worker, url, opts)
+            entry = {'future': future, 'waiters': 0, 'started': time.perf_counter()}
+            self.inflight[inflight_key] = entry
+            future.add_done_callback(lambda _: self._forget(inflight_key, entry))
+        entry['waiters'] += 1
+        try:
+            return await asyncio.shield(entry['future'])
+        finally:
+            entry['waiters'] -= 1
+            if entry['waiters'] == 0 and not entry['future'].done():
+                entry['future'].cancel()
+
+    def _forget(self, inflight_key, entry):
+        if self.inflight.get(inflight_key) is entry:
+            del self.inflight[inflight_key]
+        future = entry['future']
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            metrics.extraction_errors.inc()
+        else:
+            metrics.extraction.observe(time.perf_counter() - entry['started'])
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+extraction_service = ExtractionService()
+
+async def resolve_stream(url):
+    """
+    Return the stream cache entry for a URL, extracting it first on a miss.
+    Returns None if extraction fails.
+    """
+    video_id = extract_video_id(url)
+    cached = stream_cache.get(video_id)
+    if cached:
+        return cached
+    if cluster is not None:
+        return await resolve_remote(url, video_id)
+    try:
+        info = await asyncio.wait_for(extraction_service.extract(url, key=video_id), EXTRACT_TIMEOUT)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"Error playing audio: {e}")
+        return None
+    if YOUTUBE_ID_RE.match(video_id):
+        title_index.add(info.get('title'), watch_url(video_id))
+    return stream_cache.put(
+        video_id, info['url'],
+        title=info.get('title'), duration=info.get('duration'), acodec=info.get('acodec')
+    )
+
+async def resolve_remote(url, video_id):
+    """Have the coordinator resolve a stream and keep a local copy of the entry."""
+    try:
+        entry = await cluster.request('resolve', url)
+    except ClusterError as e:
+        logging.error(f"Coordinator could not resolve {url}: {e}")
+        return None
+    if entry is None:
+        return None
+    if YOUTUBE_ID_RE.match(video_id):
+        title_index.add(entry.get('title'), watch_url(video_id))
+    extra = {key: value for key, value in entry.items() if key not in ('audio_url', 'expires')}
+    return stream_cache.put(video_id, entry['audio_url'], **extra)
+
+async def search_youtube(query):
+    """
+    Top YouTube results for free text as [{'title', 'url', 'duration'}].
+    Served from the search cache while fresh; identical concurrent searches share one
+    extraction. Returns an empty list if the search fails.
+    """
+    key = normalize_title(query)
+    cached = search_cache.get(key)
+    if cached is not None:
+        return cached
+    if cluster is not None:
+        try:
+            results = await cluster.request('search', query)
+        except ClusterError as e:
+            logging.error(f"Error searching YouTube: {e}")
+            return []
+        for result in results:
+            title_index.add(result['title'], result['url'])
+        search_cache.put(key, results)
+        return results
+    metrics.searches.inc()
+    try:
+        info = await asyncio.wait_for(
+            extraction_service.extract(f"ytsearch{SEARCH_RESULTS}:{query}", key=f"ytsearch:{key}", opts=SEARCH_OPTIONS),
+            EXTRACT_TIMEOUT
+        )
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.error(f"Error searching YouTube: {e}")
+        return []
+    results = []
+    for entry in info.get('entries') or ():
+        video_id = entry.get('id')
+        if not video_id or not YOUTUBE_ID_RE.match(video_id):
+            continue
+        url = watch_url(video_id)
+        results.append({'title': entry.get('title') or url, 'url': url, 'duration': entry.get('duration')})
+        title_index.add(entry.get('title'), url)
+    search_cache.put(key, results)
+    return results
+
+class PlaylistFeed:
+    """
+    Reads a playlist lazily through yt-dlp's flat extraction.
+    yt-dlp only fetches the next page of the playlist once the entries generator
+    gets there, so a long playlist costs no more up front than a single video.
+    Entries are pulled on a worker thread since paging does network I/O.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.title = None
+        self.entries = None
+        self.taken = 0
+        self.exhausted = False
+
+    def _open(self):
+        # A fresh instance per playlist, as the generator keeps using it between pulls
+        ydl = load_youtube_dl().YoutubeDL(PLAYLIST_OPTIONS)
+        info = ydl.extract_info(self.url, download=False, process=False)
+        # /playlist links are handed over to the tab extractor
+        while info.get('_type') in ('url', 'url_transparent'):
+            info = ydl.extract_info(info['url'], download=False, process=False, ie_key=info.get('ie_key'))
+        self.title = info.get('title')
+        return iter(info.get('entries') or ())
+
+    def _pull(self, count):
+        if self.entries is None:
+            self.entries = self._open()
+        entries = list(itertools.islice(self.entries, count))
+        tracks = []
+        for entry in entries:
+            video_id = entry.get('id')
+            if video_id and YOUTUBE_ID_RE.match(video_id):
+                url = watch_url(video_id)
+            elif entry.get('url'):
+                url = entry['url']
+            else:
+                continue
+            tracks.append({'url': url, 'title': entry.get('title')})
+        return tracks, len(entries)
+
+    async def take(self, count):
+        """The next `count` tracks, fewer once the playlist runs out."""
+        count = min(count, PLAYLIST_MAX_TRACKS - self.taken)
+        if self.exhausted or count <= 0:
+            self.exhausted = True
+            return []
+        try:
+            tracks, pulled = await asyncio.get_running_loop().run_in_executor(None, self._pull, count)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Error reading playlist: {e}")
+            tracks, pulled = [], 0
+        self.taken += pulled
+        if pulled < count:
+            self.exhausted = True
+        return tracks
+
+async def measure_loudness(audio_url):
+    """Integrated loudness and true peak of a stream from FFmpeg's loudnorm, or None."""
+    args = [
+        'ffmpeg', '-hide_banner', '-nostats', *FFMPEG_OPTIONS['before_options'].split(),
+        '-t', str(LOUDNESS_ANALYZE_SECONDS), '-i', audio_url,
+        '-vn', '-af', f'loudnorm=I={LOUDNESS_TARGET}:print_format=json', '-f', 'null', '-'
+    ]
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    except OSError as e:
+        logging.error(f"Could not start FFmpeg for loudness analysis: {e}")
+        return None
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), LOUDNESS_ANALYZE_TIMEOUT)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        process.kill()
+        await process.wait()
+        raise
+    # loudnorm prints its measurements as the last JSON object on stderr
+    text = stderr.decode(errors='replace')
+    try:
+        data = json.loads(text[text.rindex('{'):text.rindex('}') + 1])
+        lufs, peak = float(data['input_i']), float(data['input_tp'])
+    except (ValueError, KeyError):
+        return None
+    # Silence measures as -inf, which no gain can fix
+    if not (math.isfinite(lufs) and math.isfinite(peak)):
+        return None
+    return {'lufs': lufs, 'peak': peak}
+
+loudness_semaphore = None
+loudness_tasks = {}
+# Videos that couldn't be measured aren't tried again until restart
+loudness_failures = set()
+
+def get_loudness_semaphore():
+    """Created on first use, since before Python 3.10 it binds to the loop current at creation."""
+    global loudness_semaphore
+    if loudness_semaphore is None:
+        loudness_semaphore = asyncio.Semaphore(LOUDNESS_CONCURRENCY)
+    return loudness_semaphore
+
+async def analyze_loudness(video_id, audio_url):
+    """Measure a video (on the coordinator in cluster mode) and cache the result."""
+    if cluster is not None:
+        try:
+            entry = await cluster.request('loudness', video_id, audio_url)
+        except ClusterError as e:
+            logging.error(f"Loudness analysis of {video_id} failed: {e}")
+            return None
+    else:
+        async with get_loudness_semaphore():
+            try:
+                entry = await measure_loudness(audio_url)
+            except asyncio.TimeoutError:
+                logging.error(f"Loudness analysis of {video_id} timed out")
+                entry = None
+    if entry is None:
+        loudness_failures.add(video_id)
+    else:
+        loudness_cache.put(video_id, entry)
+    return entry
+
+def schedule_loudness(video_id, audio_url):
+    """Start measuring a video in the background unless it is known or already being measured."""
+    if not LOUDNESS_NORMALIZE or not audio_url:
+        return None
+    if loudness_cache.peek(video_id) is not None or video_id in loudness_failures:
+        return None
+    task = loudness_tasks.get(video_id)
+    if task is None:
+        task = loudness_tasks[video_id] = asyncio.ensure_future(analyze_loudness(video_id, audio_url))
+        task.add_done_callback(lambda _: loudness_tasks.pop(video_id, None))
+    return task
+
+def cancel_loudness_analysis():
+    for task in list(loudness_tasks.values()):
+        task.cancel()
+
+def process_cpu_seconds(pid):
+    """Total user+system CPU time of a process, or None if it can't be read."""
+    if psutil is not None:
+        try:
+            times = psutil.Process(pid).cpu_times()
+            return times.user + times.system
+        except psutil.Error:
+            return None
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def is_unity_volume(volume):
+    return abs(volume - 1.0) < 0.01
+
+class NumpyVolumeTransformer(discord.AudioSource):
+    """
+    Drop-in replacement for discord.PCMVolumeTransformer that scales 16-bit stereo PCM with NumPy.
+    Volume changes ramp linearly across the next read so they don't click, and
+    `batch_frames` > 1 reads and scales several 20 ms frames per call.
+    """
+    def __init__(self, original, volume=1.0, batch_frames=1):
+        self.original = original
+        self.batch_frames = max(1, batch_frames)
+        self._volume = max(volume, 0.0)
+        self._gain = self._volume
+        self._pending = deque()
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self._volume = max(value, 0.0)
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        self.original.cleanup()
+
+    def read(self):
+        if self._pending:
+            return self._pending.popleft()
+        frames = []
+        for _ in range(self.batch_frames):
+            data = self.original.read()
+            if not data:
+                break
+            frames.append(data)
+        if not frames:
+            return b''
+
+        start_gain, target = self._gain, self._volume
+        if start_gain == target == 1.0:
+            self._pending.extend(frames[1:])
+            return frames[0]
+
+        # frombuffer is a zero-copy view over FFmpeg's bytes
+        samples = np.frombuffer(b''.join(frames), dtype=np.int16).reshape(-1, 2)
+        if start_gain == target:
+            scaled = samples * np.float32(target)
+        else:
+            ramp = np.linspace(start_gain, target, len(samples), dtype=np.float32)
+            scaled = samples * ramp[:, None]
+        self._gain = target
+        out = np.clip(scaled, -32768, 32767).astype(np.int16).tobytes()
+
+        frame_size = len(frames[0])
+        self._pending.extend(out[i:i + frame_size] for i in range(frame_size, len(out), frame_size))
+        return out[:frame_size]
+
+def load_numpy():
+    """Import NumPy on first use; returns None when it isn't installed."""
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        np = numpy
+    return np or None
+
+def make_volume_transformer(source, volume):
+    if VOLUME_MODE == 'numpy' and load_numpy() is not None:
+        return NumpyVolumeTransformer(source, volume, VOLUME_BATCH_FRAMES)
+    return discord.PCMVolumeTransformer(source, volume)
+
+class MeteredSource(discord.AudioSource):
+    """
+    Wraps a playback source to count the 20 ms frames sent and the CPU spent producing them.
+    `mode` is 'opus' for passthrough, 'filter' for an FFmpeg-applied gain and 'pcm'
+    for the decode/volume/re-encode pipeline. `fixed_volume` is set when the gain
+    can't be changed without restarting the stream.
+    """
+    def __init__(self, source, mode, start_at=0.0, fixed_volume=None):
+        self.source = source
+        self.mode = mode
+        self.start_at = start_at
+        self.fixed_volume = fixed_volume
+        # FrameBuffer recording the Opus packets as they are sent
+        self.capture = None
+        # (histogram, start) to observe when the first frame goes out
+        self.first_audio = None
+        self.frames = 0
+        self.read_cpu = 0.0
+        self.started = time.monotonic()
+
+    def read(self):
+        start = time.thread_time()
+        data = self.source.read()
+        self.read_cpu += time.thread_time() - start
+        if data:
+            self.frames += 1
+            if self.first_audio is not None:
+                histogram, requested_at = self.first_audio
+                histogram.observe(time.perf_counter() - requested_at)
+                self.first_audio = None
+        if self.capture is not None:
+            if data:
+                self.capture.append(data)
+            else:
+                self.capture.finish()
+        return data
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+
+    @property
+    def volume(self):
+        if self.fixed_volume is not None:
+            return self.fixed_volume
+        return getattr(self.source, 'volume', 1.0)
+
+    def accepts_volume(self, volume):
+        """Whether `volume` can be applied without restarting the stream."""
+        return self.fixed_volume is None or abs(self.fixed_volume - volume) < 0.01
+
+    @volume.setter
+    def volume(self, value):
+        if hasattr(self.source, 'volume'):
+            self.source.volume = value
+
+    @property
+    def position(self):
+        """Seconds into the track, based on frames actually read."""
+        return self.start_at + self.frames * 0.02
+
+    def ffmpeg_process(self):
+        inner = getattr(self.source, 'original', self.source)
+        return getattr(inner, '_process', None)
+
+    def cpu_report(self):
+        """
+        CPU use as a percentage of one core since the stream started.
+        'python' covers reading and volume scaling only; Opus encoding of PCM
+        streams happens in discord.py after read() and isn't included.
+        """
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        process = self.ffmpeg_process()
+        ffmpeg_cpu = process_cpu_seconds(process.pid) if process else None
+        return {
+            'mode': self.mode,
+            'position': self.position,
+            'ffmpeg': ffmpeg_cpu / elapsed * 100 if ffmpeg_cpu is not None else None,
+            'python': self.read_cpu / elapsed * 100,
+        }
 
-# Define file names
-WHITELIST_FILE = 'whitelist.json'
-PUBLICP_FILE = 'publicp.json'
-SERVERS_FILE = 'servers.json'
-STATUS_CHANNEL_FILE = 'status_channel.json'
-STATUS_MESSAGES_FILE = 'status_messages.json'
-CACHED_SONG_FILE = "cached_song.json"
+class FrameBuffer:
+    """
+    The Opus packets of one track, recorded while it plays so Loop and Replay don't
+    need the network or FFmpeg. Only usable once the whole track has been captured.
+    """
+    def __init__(self, video_id, memory_budget=LOOP_BUFFER_MEMORY, max_bytes=LOOP_BUFFER_MAX_BYTES):
+        self.video_id = video_id
+        self.max_bytes = max_bytes
+        self.file = tempfile.SpooledTemporaryFile(max_size=memory_budget)
+        self.offsets = array('Q')
+        self.size = 0
+        self.complete = False
+        # Written from the voice player thread, read and released from the event loop
+        self.lock = threading.Lock()
 
-def save_json(file, data):
-    with open(file, 'w') as f:
-        json.dump(data, f)
+    @property
+    def usable(self):
+        return self.complete and self.file is not None
 
-def load_json(file):
-    if os.path.exists(file):
-        with open(file, 'r') as f:
-            try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                return {}
-    return {}
+    def append(self, packet):
+        with self.lock:
+            if self.file is None or self.complete:
+                return
+            if self.size + len(packet) > self.max_bytes:
+                self._close()
+                return
+            self.file.seek(self.size)
+            self.file.write(packet)
+            self.offsets.append(self.size)
+            self.size += len(packet)
 
-# Initialize JSON files if they don't exist
-def initialize_json_files():
-    files_defaults = {
-        WHITELIST_FILE: {'whitelisted_users': []},
-        PUBLICP_FILE: {},
-        SERVERS_FILE: {'servers': {}},
-        STATUS_CHANNEL_FILE: {'channel_id': None},
-        STATUS_MESSAGES_FILE: {'messages': {}},
-        CACHED_SONG_FILE: {}
-    }
-    for file, default in files_defaults.items():
-        if not os.path.exists(file):
-            save_json(file, default)
+    def finish(self):
+        with self.lock:
+            if self.file is not None:
+                self.complete = True
 
-initialize_json_files()
+    def read_frame(self, index):
+        with self.lock:
+            if self.file is None or index >= len(self.offsets):
+                return b''
+            start = self.offsets[index]
+            end = self.offsets[index + 1] if index + 1 < len(self.offsets) else self.size
+            self.file.seek(start)
+            return self.file.read(end - start)
 
-def load_whitelist():
-    data = load_json(WHITELIST_FILE)
-    return data.get('whitelisted_users', [])
+    def close(self):
+        with self.lock:
+            self._close()
 
-def save_whitelist(whitelisted_users):
-    save_json(WHITELIST_FILE, {'whitelisted_users': whitelisted_users})
+    def _close(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.complete = False
 
-def load_publicp():
-    return load_json(PUBLICP_FILE)
+class BufferedOpusSource(discord.AudioSource):
+    """Plays a completed FrameBuffer back, optionally from an offset in seconds."""
+    def __init__(self, buffer, start_at=0.0):
+        self.buffer = buffer
+        self.index = int(start_at / 0.02)
 
-def save_publicp(publicp):
-    save_json(PUBLICP_FILE, publicp)
+    def read(self):
+        data = self.buffer.read_frame(self.index)
+        self.index += 1
+        return data
 
-def load_servers():
-    data = load_json(SERVERS_FILE)
-    return data.get('servers', {})
+    def is_opus(self):
+        return True
 
-def save_servers(servers):
-    save_json(SERVERS_FILE, {'servers': servers})
+def create_source(audio_url, volume=1.0, acodec=None, start_at=0.0):
+    started = time.perf_counter()
+    source = _build_source(audio_url, volume, acodec, start_at)
+    metrics.ffmpeg_spawn.observe(time.perf_counter() - started)
+    metrics.ffmpeg_spawns.inc()
+    return source
 
-def load_status_channel():
-    data = load_json(STATUS_CHANNEL_FILE)
-    return data.get('channel_id', None)
+def _build_source(audio_url, volume, acodec, start_at):
+    """
+    Build the FFmpeg source for a stream.
+    Opus streams at 100% volume are copied through untouched; anything else is
+    decoded to PCM and scaled either by FFmpeg (VOLUME_MODE=ffmpeg) or in Python.
+    """
+    options = dict(FFMPEG_OPTIONS)
+    if start_at:
+        options['before_options'] = f"-ss {start_at:.2f} {options['before_options']}"
+    if PLAYBACK_MODE != 'pcm' and acodec == 'opus' and is_unity_volume(volume):
+        # 'opus' means stream copy on every discord.py 2.x; older releases re-encode 'copy'
+        source = discord.FFmpegOpusAudio(audio_url, codec='opus', **options)
+        return MeteredSource(source, 'opus', start_at, fixed_volume=1.0)
+    if VOLUME_MODE == 'ffmpeg':
+        options['options'] = f"{options['options']} -af volume={volume:.2f}"
+        source = discord.FFmpegPCMAudio(audio_url, **options)
+        return MeteredSource(source, 'filter', start_at, fixed_volume=volume)
+    source = discord.FFmpegPCMAudio(audio_url, **options)
+    return MeteredSource(make_volume_transformer(source, volume), 'pcm', start_at)
 
-def save_status_channel(channel_id):
-    save_json(STATUS_CHANNEL_FILE, {'channel_id': channel_id})
+class GuildQueue:
+    """
+    Upcoming tracks for one guild.
+    While a track plays, the next one is resolved and its FFmpeg source spawned
+    ahead of time so advancing the queue doesn't wait on extraction or FFmpeg startup.
+    """
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.tracks = deque()
+        self.current = None
+        self.current_ends_at = None
+        # Bumped for every track started, so stale after-callbacks can be ignored
+        self.generation = 0
+        self.prefetched = None
+        self.prefetch_target = None
+        self.prefetch_task = None
+        self.loop_buffer = None
+        self.expand_lock = asyncio.Lock()
+        self.expand_task = None
+        self.resolve_tasks = set()
 
-def load_status_messages():
-    data = load_json(STATUS_MESSAGES_FILE)
-    return data.get('messages', {})
+    def enqueue(self, url, requester=None):
+        """Add a track and return its position, or None if the queue is full."""
+        if len(self.tracks) >= QUEUE_MAX_LENGTH:
+            return None
+        cached = stream_cache.peek(extract_video_id(url))
+        self.tracks.append({'url': url, 'title': cached.get('title') if cached else None, 'requester': requester})
+        return len(self.tracks)
 
-def save_status_messages(messages):
-    save_json(STATUS_MESSAGES_FILE, {'messages': messages})
+    def enqueue_playlist(self, url, requester=None):
+        """
+        Add a placeholder that expands into the playlist's tracks as playback nears it.
+        The placeholder takes one slot; returns its position, or None if the queue is full.
+        """
+        if len(self.tracks) >= QUEUE_MAX_LENGTH:
+            return None
+        self.tracks.append({'url': url, 'title': None, 'requester': requester, 'feed': PlaylistFeed(url)})
+        return len(self.tracks)
+
+    def clear(self):
+        self.tracks.clear()
+        self.drop_prefetch()
+        if self.expand_task and not self.expand_task.done():
+            self.expand_task.cancel()
+        self.expand_task = None
+        for task in self.resolve_tasks:
+            task.cancel()
+        self.resolve_tasks.clear()
+
+    def needs_expansion(self):
+        return any('feed' in track for track in itertools.islice(self.tracks, PLAYLIST_LOOKAHEAD))
+
+    async def expand(self):
+        """Pull playlist entries in ahead of their placeholders until the next few tracks are concrete."""
+        async with self.expand_lock:
+            while True:
+                placeholder = next(
+                    (track for track in itertools.islice(self.tracks, PLAYLIST_LOOKAHEAD) if 'feed' in track), None)
+                if placeholder is None:
+                    return
+                index = self.tracks.index(placeholder)
+                tracks = await placeholder['feed'].take(PLAYLIST_LOOKAHEAD - index)
+                # The queue may have been cleared or advanced while the page loaded
+                index = next((i for i, track in enumerate(self.tracks) if track is placeholder), None)
+                if index is None:
+                    return
+                for offset, track in enumerate(tracks):
+                    track['requester'] = placeholder['requester']
+                    self.tracks.insert(index + offset, track)
+                if placeholder['feed'].exhausted:
+                    self.tracks.remove(placeholder)
+
+    async def _expand_and_prefetch(self, voice_client):
+        await self.expand()
+        self.schedule_prefetch(voice_client)
+
+    def resolve_ahead(self):
+        """Warm the stream cache for the tracks after the one being prefetched."""
+        for track in itertools.islice(self.tracks, 1, PLAYLIST_LOOKAHEAD):
+            if 'feed' in track or stream_cache.peek(extract_video_id(track['url'])):
+                continue
+            task = asyncio.ensure_future(resolve_stream(track['url']))
+            self.resolve_tasks.add(task)
+            task.add_done_callback(self.resolve_tasks.discard)
+
+    def drop_prefetch(self):
+        if self.prefetch_task and not self.prefetch_task.done():
+            self.prefetch_task.cancel()
+        self.prefetch_task = None
+        self.prefetch_target = None
+        if self.prefetched:
+            self.prefetched[1].cleanup()
+            self.prefetched = None
+
+    def buffered_source(self, video_id, start_at=0.0):
+        """A source replaying the captured frames of `video_id`, if we have all of them."""
+        buffer = self.loop_buffer
+        if buffer is None or buffer.video_id != video_id or not buffer.usable:
+            return None
+        return MeteredSource(BufferedOpusSource(buffer, start_at), 'buffer', start_at, fixed_volume=1.0)
+
+    def start_capture(self, video_id, source):
+        """Record `source` into a fresh loop buffer, replacing the previous track's."""
+        buffer = self.loop_buffer
+        if buffer is not None and buffer.video_id == video_id and buffer.usable:
+            return
+        self.release_buffer()
+        self.loop_buffer = FrameBuffer(video_id)
+        source.capture = self.loop_buffer
+
+    def release_buffer(self):
+        if self.loop_buffer is not None:
+            self.loop_buffer.close()
+            self.loop_buffer = None
+
+    def take_prefetched(self, track):
+        """Hand over the pre-spawned source for `track`, if that is what was prefetched."""
+        if self.prefetched and self.prefetched[0] is track:
+            source = self.prefetched[1]
+            self.prefetched = None
+            self.prefetch_target = None
+            return source
+        self.drop_prefetch()
+        return None
+
+    def schedule_prefetch(self, voice_client):
+        """Resolve the next track and pre-spawn its source at the volume `voice_client` is playing at."""
+        if not self.tracks:
+            return
+        if self.needs_expansion():
+            if self.expand_task is None or self.expand_task.done():
+                self.expand_task = asyncio.ensure_future(self._expand_and_prefetch(voice_client))
+            return
+        self.resolve_ahead()
+        upcoming = self.tracks[0]
+        if self.prefetch_target is upcoming:
+            return
+        self.drop_prefetch()
+        self.prefetch_target = upcoming
+        self.prefetch_task = asyncio.ensure_future(self._prefetch(upcoming, voice_client))
+
+    async def _prefetch(self, track, voice_client):
+        entry = await resolve_stream(track['url'])
+        if entry is None or self.prefetch_target is not track:
+            return
+        track['title'] = track['title'] or entry.get('title')
+        video_id = extract_video_id(track['url'])
+        # Measure while the current track plays so this one starts normalized
+        schedule_loudness(video_id, entry['audio_url'])
+        if self.current_ends_at is not None:
+            delay = self.current_ends_at - PREFETCH_LEAD - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if self.prefetch_target is track:
+            # Read the volume only now, so changes made while waiting are picked up
+            controls = getattr(voice_client, "player_controls", None)
+            level = (controls.volume if controls else 1.0) * loudness_cache.gain(video_id)
+            self.prefetched = (track, create_source(entry['audio_url'], level, acodec=entry.get('acodec')))
+
+guild_queues = {}
 
-def load_cached_song():
-    return load_json(CACHED_SONG_FILE)
+def get_guild_queue(guild_id):
+    queue = guild_queues.get(guild_id)
+    if queue is None:
+        queue = guild_queues[guild_id] = GuildQueue(guild_id)
+    return queue
 
-def save_cached_song(url, audio_url):
-    save_json(CACHED_SONG_FILE, {"url": url, "audio_url": audio_url})
+pending_plays = {}
+
+def clear_guild_playback(guild_id, disconnecting=False):
+    """
+    Drop the guild's queue and cancel a /playbot that is still resolving.
+    The loop buffer survives a plain stop so Replay can still use it.
+    """
+    queue = get_guild_queue(guild_id)
+    queue.clear()
+    if disconnecting:
+        queue.release_buffer()
+    pending = pending_plays.pop(guild_id, None)
+    if pending and not pending.done():
+        pending.cancel()
+
+def start_pending_play(guild_id, coro):
+    """
+    Run `coro`, which is about to start a track, tracked like a /playbot so requests
+    arriving meanwhile are queued behind it instead of racing it to the voice client.
+    If a play is already on its way, the track it starts will advance the queue, so
+    `coro` is dropped and that play is returned instead.
+    """
+    pending = pending_plays.get(guild_id)
+    if pending and not pending.done():
+        coro.close()
+        return pending
+    task = asyncio.ensure_future(coro)
+    pending_plays[guild_id] = task
+    task.add_done_callback(lambda _: pending_plays.pop(guild_id, None) if pending_plays.get(guild_id) is task else None)
+    return task
+
+def start_queued_tracks(voice_client):
+    """
+    Start the queue after a /playbot that others queued behind failed or was cancelled,
+    since no after-callback will ever advance it. Returns the guild's PlayerControls
+    when the queue was started, so the reply can carry them.
+    """
+    guild_id = voice_client.guild.id
+    queue = get_guild_queue(guild_id)
+    if not queue.tracks or not voice_client.is_connected():
+        return None
+    if voice_client.is_playing() or voice_client.is_paused():
+        return None
+    controls = getattr(voice_client, "player_controls", None)
+    if controls is None:
+        controls = voice_client.player_controls = PlayerControls(voice_client)
+    start_pending_play(guild_id, play_next(voice_client))
+    return controls
 
 class PlayerControls(discord.ui.View):
     def __init__(self, voice_client):
@@ -123,8 +2014,9 @@ class PlayerControls(discord.ui.View):
     @discord.ui.button(label="Stop", style=discord.ButtonStyle.danger)
     async def stop(self, interaction: discord.Interaction, button: discord.ui.Button):
         if self.voice_client.is_playing() or self.voice_client.is_paused():
-            # Mark as forced stop so after_playing() won't loop
+            # Mark as forced stop so after_playing() won't loop or advance the queue
             self.forced_stop = True
+            clear_guild_playback(self.voice_client.guild.id)
             self.voice_client.stop()
             await interaction.response.send_message("Stopped the audio.", ephemeral=True)
         else:
@@ -133,13 +2025,19 @@ class PlayerControls(discord.ui.View):
     @discord.ui.button(label="Disconnect", style=discord.ButtonStyle.danger)
     async def disconnect(self, interaction: discord.Interaction, button: discord.ui.Button):
         if self.voice_client:
-            # Mark forced_stop so no loop replay
-            self.forced_stop = True
+            # Stops this view too; the voice client may be gone by the time the voice state update arrives
+            release_guild_resources(self.voice_client.guild.id, self.voice_client)
             await self.voice_client.disconnect()
             await interaction.response.send_message("Disconnected from the voice channel.", ephemeral=True)
         else:
             await interaction.response.send_message("Bot is not in a voice channel.", ephemeral=True)
 
+    @discord.ui.button(label="Skip", style=discord.ButtonStyle.secondary)
+    async def skip(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.defer()
+        message = await skip_track(self.voice_client)
+        await send_followup(interaction, message, ephemeral=True)
+
     @discord.ui.button(label="Loop", style=discord.ButtonStyle.secondary)
     async def loop(self, interaction: discord.Interaction, button: discord.ui.Button):
         self.looping = not self.looping
@@ -168,140 +2066,514 @@ class PlayerControls(discord.ui.View):
                         self.voice_client = interaction.guild.voice_client
                         self.voice_client.player_controls = self
                     else:
-                        await interaction.followup.send("No saved voice channel to reconnect to.", ephemeral=True)
+                        await send_followup(interaction, "No saved voice channel to reconnect to.", ephemeral=True)
                         return
                 else:
-                    await interaction.followup.send("No audio source available to replay.", ephemeral=True)
+                    await send_followup(interaction, "No audio source available to replay.", ephemeral=True)
                     return
 
             # Reset forced_stop so the loop can function if needed
             self.forced_stop = False
 
             # Actually replay the audio
-            await play_audio(self.voice_client, self.last_url, self.volume, replay=True)
-            await interaction.followup.send("Replaying the last requested audio.", ephemeral=True)
+            await play_audio(self.voice_client, self.last_url, self.volume)
+            await send_followup(interaction, "Replaying the last requested audio.", ephemeral=True)
         else:
-            await interaction.followup.send("No audio source available to replay.", ephemeral=True)
+            await send_followup(interaction, "No audio source available to replay.", ephemeral=True)
 
     @discord.ui.button(label="🔊 Volume Up", style=discord.ButtonStyle.success)
     async def volume_up(self, interaction: discord.Interaction, button: discord.ui.Button):
         self.volume = min(self.volume + 0.1, 2.0)
-        if self.voice_client.source:
-            self.voice_client.source.volume = self.volume
-        percent = int(self.volume * 100)
+        percent = int(round(self.volume * 100))
         await interaction.response.send_message(f"Volume increased to {percent}%.", ephemeral=True)
+        await apply_volume(self.voice_client, self.volume)
 
     @discord.ui.button(label="🔉 Volume Down", style=discord.ButtonStyle.success)
     async def volume_down(self, interaction: discord.Interaction, button: discord.ui.Button):
         self.volume = max(self.volume - 0.1, 0.1)
-        if self.voice_client.source:
-            self.voice_client.source.volume = self.volume
-        percent = int(self.volume * 100)
+        percent = int(round(self.volume * 100))
         await interaction.response.send_message(f"Volume decreased to {percent}%.", ephemeral=True)
+        await apply_volume(self.voice_client, self.volume)
 
-async def play_audio(voice_client, url, volume=1.0, replay=False):
+async def play_audio(voice_client, url, volume=1.0, source=None, start_at=0.0, first_audio=None, resumes=0):
     """
-    Play or replay an audio URL (YouTube).
-    If replay=True, we skip the YT-DL extraction if there's a cached URL matching 'url'.
+    Play an audio URL (YouTube), from the start or from `start_at` seconds in.
+    The YT-DL extraction is skipped whenever the stream cache holds a live URL for the video,
+    `source` can carry an FFmpeg source the guild queue already spawned, and a track
+    captured in the guild's loop buffer is replayed from there without FFmpeg.
+    `first_audio` is a (histogram, start time) observed when the first frame is sent.
+    `resumes` counts how often this track was already resumed after its stream dropped.
+    With loudness normalization on, a measured track's gain is folded into `volume`.
     """
-    cached_song = load_cached_song()
-    if replay and cached_song and cached_song.get("url") == url:
-        audio_url = cached_song.get("audio_url")
-    else:
-        ydl_opts = {'format': 'bestaudio/best', 'noplaylist': True}
-        try:
-            loop = asyncio.get_event_loop()
-            with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-                info = await loop.run_in_executor(None, lambda: ydl.extract_info(url, download=False))
-                audio_url = info['url']
-                save_cached_song(url, audio_url)
-        except Exception as e:
-            print(f"Error playing audio: {e}")
+    started = time.perf_counter()
+    video_id = extract_video_id(url)
+    queue = get_guild_queue(voice_client.guild.id)
+    gain = loudness_cache.gain(video_id)
+    level = volume * gain
+    if source is not None and not source.accepts_volume(level):
+        # Prefetched with a fixed gain, but the volume was changed after it was spawned
+        source.cleanup()
+        source = None
+    if source is None and is_unity_volume(level):
+        source = queue.buffered_source(video_id, start_at)
+    if source is None:
+        entry = await resolve_stream(url)
+        if entry is None:
             return None
+        source = create_source(entry['audio_url'], level, acodec=entry.get('acodec'), start_at=start_at)
+    else:
+        entry = stream_cache.peek(video_id) or {}
+        source.volume = level
+    # Measured now, applied from the next play on
+    schedule_loudness(video_id, entry.get('audio_url'))
+    if source.mode == 'opus' and not start_at:
+        queue.start_capture(video_id, source)
 
-    ffmpeg_options = {
-        'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-        'options': '-vn'
-    }
-    source = discord.FFmpegPCMAudio(audio_url, **ffmpeg_options)
-    source = discord.PCMVolumeTransformer(source, volume)
+    duration = entry.get('duration')
+    previous = (queue.generation, queue.current, queue.current_ends_at)
+    queue.generation += 1
+    generation = queue.generation
+    queue.current = {'url': url, 'title': entry.get('title'), 'gain': gain}
+    queue.current_ends_at = time.monotonic() + duration - start_at if duration else None
 
     def after_playing(error):
         if error:
             print(f"Error playing audio: {error}")
+            metrics.playback_errors.inc()
+
+        # A newer track (skip, replay, next in queue) already took over
+        if queue.generation != generation:
+            return
+
+        controls = getattr(voice_client, "player_controls", None)
+        if controls and controls.forced_stop:
+            return
+
+        # FFmpeg gave out before the end (expired URL, dropped connection): continue from there
+        if resumes < STREAM_RESUME_ATTEMPTS and stream_dropped(source, duration, error):
+            coro = resume_track(voice_client, url, source.position, resumes + 1, source.capture)
+        # If loop is enabled and we didn't forcibly stop, replay
+        elif controls and controls.looping:
+            coro = play_audio(voice_client, url, controls.volume)
+        # Removed auto-disconnect here; the idle timer handles it
+        else:
+            coro = play_next(voice_client)
+        client.loop.call_soon_threadsafe(start_pending_play, voice_client.guild.id, coro)
+
+    controls = getattr(voice_client, "player_controls", None)
+    if controls:
+        controls.forced_stop = False
+        controls.last_url = url
+    source.first_audio = first_audio
+    metrics.play_audio.observe(time.perf_counter() - started)
+    try:
+        voice_client.play(source, after=lambda e: after_playing(e))
+    except Exception:
+        # Nothing started, so whatever was current stays current
+        queue.generation, queue.current, queue.current_ends_at = previous
+        source.cleanup()
+        raise
+    queue.schedule_prefetch(voice_client)
+    return source
+
+def stream_dropped(source, duration, error):
+    """Whether a source stopped short of the end of its track because the stream failed."""
+    if source.mode == 'buffer':
+        return False
+    if error is not None:
+        return True
+    return bool(duration) and source.position < duration - STREAM_RESUME_MARGIN
+
+async def invalidate_stream(video_id):
+    stream_cache.invalidate(video_id)
+    if cluster is not None:
+        try:
+            await cluster.request('invalidate', video_id)
+        except ClusterError as e:
+            logging.error(f"Could not invalidate {video_id} on the coordinator: {e}")
+
+async def resume_track(voice_client, url, start_at, resumes, capture=None):
+    """
+    Restart a track whose stream dropped, from the position it reached, with a freshly
+    resolved URL. Falls through to the next track if it can't be resumed.
+    """
+    if not voice_client.is_connected():
+        return
+    queue = get_guild_queue(voice_client.guild.id)
+    # Whatever the dropped stream captured is incomplete; don't let Loop/Replay use it
+    if capture is not None and queue.loop_buffer is capture:
+        queue.release_buffer()
+    # The usual cause is an expired or revoked googlevideo URL
+    await invalidate_stream(extract_video_id(url))
+    metrics.stream_resumes.inc()
+    logging.warning(f"Stream dropped at {start_at:.1f}s, resuming (attempt {resumes}/{STREAM_RESUME_ATTEMPTS})")
+    controls = getattr(voice_client, "player_controls", None)
+    volume = controls.volume if controls else 1.0
+    if not await play_audio(voice_client, url, volume, start_at=start_at, resumes=resumes):
+        await play_next(voice_client)
+
+async def apply_volume(voice_client, volume):
+    """
+    Set the volume of whatever is playing.
+    Opus passthrough and FFmpeg-filtered streams have their gain fixed, so those are
+    restarted with the new volume from the position they had reached.
+    """
+    source = voice_client.source
+    if source is None:
+        return
+    queue = get_guild_queue(voice_client.guild.id)
+    # The track keeps the loudness gain it started with
+    level = volume * (queue.current.get('gain', 1.0) if queue.current else 1.0)
+    if isinstance(source, MeteredSource) and not source.accepts_volume(level):
+        if not queue.current:
+            return
+        # Make the stopped stream's after-callback stale before stopping it
+        queue.generation += 1
+        metrics.ffmpeg_restarts.inc()
+        was_paused = voice_client.is_paused()
+        voice_client.stop()
+        await play_audio(voice_client, queue.current['url'], volume, start_at=source.position)
+        if was_paused:
+            voice_client.pause()
+    else:
+        source.volume = level
+
+async def play_next(voice_client, first_audio=None):
+    """
+    Start the next queued track, skipping any that fail to resolve.
+    `first_audio` is passed on to play_audio for the first track attempted.
+    """
+    queue = get_guild_queue(voice_client.guild.id)
+    while queue.tracks:
+        if not voice_client.is_connected():
+            queue.clear()
+            break
+        advanced_at = time.perf_counter()
+        await queue.expand()
+        if not queue.tracks:
+            break
+        track = queue.tracks.popleft()
+        source = queue.take_prefetched(track)
+        controls = getattr(voice_client, "player_controls", None)
+        volume = controls.volume if controls else 1.0
+        result = await play_audio(
+            voice_client, track['url'], volume, source=source,
+            first_audio=first_audio or (metrics.track_transition, advanced_at)
+        )
+        first_audio = None
+        if result:
+            return result
+    queue.current = None
+    queue.current_ends_at = None
+    return None
+
+async def skip_track(voice_client):
+    """Skip the current track and return a message describing what plays next."""
+    if not voice_client or not voice_client.is_connected():
+        return "Bot is not in a voice channel."
+    # Make the skipped track's after-callback stale, so it neither loops nor looks like a dropped stream
+    get_guild_queue(voice_client.guild.id).generation += 1
+    if voice_client.is_playing() or voice_client.is_paused():
+        voice_client.stop()
+    task = start_pending_play(voice_client.guild.id, play_next(voice_client))
+    try:
+        source = await task
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            raise
+        return "Skipped. Playback was stopped."
+    if source:
+        title = get_guild_queue(voice_client.guild.id).current.get('title')
+        return f"Skipped. Now playing: {title}" if title else "Skipped to the next track."
+    return "Skipped. The queue is empty."
+
+idle_timers = {}
+
+def is_alone(voice_client):
+    channel = voice_client.channel if voice_client and voice_client.is_connected() else None
+    if channel is None:
+        return False
+    return not any(member.id != client.user.id for member in channel.members)
+
+def update_idle_timer(guild):
+    """Arm the guild's idle timer when the bot is left alone, cancel it when someone is back."""
+    timer = idle_timers.get(guild.id)
+    if IDLE_TIMEOUT > 0 and is_alone(guild.voice_client):
+        if timer is None:
+            idle_timers[guild.id] = client.loop.call_later(
+                IDLE_TIMEOUT, lambda: asyncio.ensure_future(idle_disconnect(guild.id))
+            )
+    elif timer is not None:
+        timer.cancel()
+        del idle_timers[guild.id]
 
+def release_guild_resources(guild_id, voice_client=None):
+    """
+    Free everything a guild's playback holds: the FFmpeg process, prefetched
+    sources, loop buffer, queue and (when given the voice client) its controls view.
+    """
+    # Make the stopped track's after-callback stale, so it doesn't start the next one
+    get_guild_queue(guild_id).generation += 1
+    if voice_client is not None:
         controls = getattr(voice_client, "player_controls", None)
         if controls:
-            # If loop is enabled and we didn't forcibly stop, replay
-            if controls.looping and not controls.forced_stop:
-                asyncio.run_coroutine_threadsafe(
-                    play_audio(voice_client, url, controls.volume, replay=True),
-                    client.loop
-                )
-                return
+            controls.forced_stop = True
+            # PlayerControls.stop is the Stop button, so call View.stop directly
+            discord.ui.View.stop(controls)
+            voice_client.player_controls = None
+        if voice_client.is_playing() or voice_client.is_paused():
+            voice_client.stop()
+    clear_guild_playback(guild_id, disconnecting=True)
+    guild_queues.pop(guild_id, None)
 
-        # Removed auto-disconnect here; rely on check_voice_channel
+async def idle_disconnect(guild_id):
+    idle_timers.pop(guild_id, None)
+    guild = client.get_guild(guild_id)
+    voice_client = guild.voice_client if guild else None
+    if not is_alone(voice_client):
         return
+    release_guild_resources(guild_id, voice_client)
+    await voice_client.disconnect()
 
-    voice_client.play(source, after=lambda e: after_playing(e))
-    return source
+http_session = None
+server_latencies = {}
+
+async def get_http_session():
+    """Return the shared, pooled aiohttp session used for status probes."""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(limit=STATUS_PROBE_CONCURRENCY, ttl_dns_cache=300)
+        http_session = aiohttp.ClientSession(connector=connector)
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+async def probe_server(session, semaphore, server_name, server_info):
+    """
+    Query a single server's /status endpoint.
+    The deadline only starts once the probe holds a concurrency slot.
+    """
+    endpoint = f"http://{server_info['ip']}:{server_info['port']}/status"
+    timeout = aiohttp.ClientTimeout(total=float(server_info.get('timeout', STATUS_PROBE_TIMEOUT)))
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            async with session.get(endpoint, timeout=timeout) as response:
+                response.raise_for_status()
+            latency = time.perf_counter() - start
+            server_latencies[server_name] = latency
+            metrics.status_probe.observe(latency)
+            return server_name, True
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Error querying server {server_name} status: {e!r}")
+            metrics.probe_failures.inc()
+            server_latencies.pop(server_name, None)
+            return server_name, False
 
-@tasks.loop(seconds=60)
-async def check_voice_channel():
+async def probe_servers(servers):
     """
-    Disconnect if alone in the channel for 60 seconds.
+    Probe all servers concurrently, at most STATUS_PROBE_CONCURRENCY at a time.
+    `servers` maps a key to server info; returns a list of (key, online) in its order.
     """
-    for guild in client.guilds:
-        voice_client = guild.voice_client
-        if voice_client and voice_client.is_connected():
-            channel = voice_client.channel
-            if len(channel.members) == 1 and client.user in channel.members:
-                await voice_client.disconnect()
+    session = await get_http_session()
+    semaphore = asyncio.Semaphore(STATUS_PROBE_CONCURRENCY)
+    return await asyncio.gather(*(
+        probe_server(session, semaphore, server_name, server_info)
+        for server_name, server_info in servers.items()
+    ))
+
+def server_key(server_info):
+    return f"{server_info['ip']}:{server_info['port']}"
+
+class ServerHistory:
+    """
+    Recent probe results of one server in a fixed-size ring of float32 latencies
+    (NaN for a failed probe), plus the debounced online state and the next probe time.
+    """
+    def __init__(self, size=STATUS_HISTORY):
+        self.samples = array('f', [math.nan]) * size
+        self.next = 0
+        self.count = 0
+        self.online = None
+        self.contrary = 0
+        self.interval = STATUS_MIN_INTERVAL
+        self.due_at = 0.0
+        self.requested_at = 0.0
+
+    def record(self, latency, now):
+        """Add a probe result (None when it failed) and schedule the next probe."""
+        self.samples[self.next] = math.nan if latency is None else latency
+        self.next = (self.next + 1) % len(self.samples)
+        self.count = min(self.count + 1, len(self.samples))
+        up = latency is not None
+        flipped = False
+        if self.online is None:
+            self.online = up
+        elif up == self.online:
+            self.contrary = 0
+        else:
+            self.contrary += 1
+            if self.contrary >= STATUS_FLIP_AFTER:
+                self.online = up
+                self.contrary = 0
+                flipped = True
+        if self.contrary or flipped:
+            # Changing state: look again soon rather than trusting one probe
+            self.interval = STATUS_MIN_INTERVAL
+        else:
+            limit = STATUS_MAX_INTERVAL if self.online else STATUS_MAX_BACKOFF
+            self.interval = min(self.interval * 2, limit)
+        self.due_at = now + self.interval
+
+    def summary(self):
+        latencies = sorted(value for value in self.samples if not math.isnan(value))
+        return {
+            'online': self.online,
+            'uptime': len(latencies) / self.count if self.count else None,
+            'p50': latencies[len(latencies) // 2] if latencies else None,
+        }
+
+class StatusMonitor:
+    """
+    Decides which servers are due for a probe and keeps their history.
+    Servers nobody has asked about for an hour are forgotten.
+    """
+    def __init__(self):
+        self.histories = {}
+        # Created on first use, since before Python 3.10 it binds to the loop current at creation
+        self.lock = None
+
+    async def poll(self, servers):
+        """Probe the servers in `servers` that are due and return a summary for each."""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            now = time.monotonic()
+            due = {}
+            for key, server_info in servers.items():
+                history = self.histories.get(key)
+                if history is None:
+                    history = self.histories[key] = ServerHistory()
+                history.requested_at = now
+                # A second of slack so ticks that land just short of the due time still count
+                if history.due_at - 1.0 <= now:
+                    due[key] = server_info
+            metrics.probes_skipped.inc(len(servers) - len(due))
+            if due:
+                for key, online in await probe_servers(due):
+                    self.histories[key].record(server_latencies.get(key) if online else None, time.monotonic())
+            for key in [key for key, history in self.histories.items() if now - history.requested_at > 3600]:
+                del self.histories[key]
+                server_latencies.pop(key, None)
+            return {key: self.histories[key].summary() for key in servers}
+
+status_monitor = StatusMonitor()
+# Latest summary per server key, for /listservers
+server_summaries = {}
+
+async def status_results(servers):
+    """
+    Summary per server key of the servers' state, uptime and median latency. Cluster
+    workers ask the coordinator, so each server is probed once for all of them.
+    """
+    if cluster is None:
+        results = await status_monitor.poll(servers)
+    else:
+        results = await cluster.request('probe', servers)
+    server_summaries.update(results)
+    return results
+
+def format_server_status(server_name, summary):
+    details = []
+    if summary['uptime'] is not None:
+        details.append(f"{summary['uptime'] * 100:.0f}% up")
+    if summary['online'] and summary['p50'] is not None:
+        details.append(f"{summary['p50'] * 1000:.0f} ms")
+    icon = "🟢" if summary['online'] else "🔴"
+    return f"{server_name} {icon} ({', '.join(details)})" if details else f"{server_name} {icon}"
 
 @tasks.loop(seconds=10)
 async def check_server_status():
-    global previous_statuses
-    status_channel_id = load_status_channel()
-    status_messages = load_status_messages()
-    servers = load_servers()
-    channel = client.get_channel(int(status_channel_id)) if status_channel_id else None
-    if not channel or not servers:
+    targets = []
+    try:
+        status_targets = await storage.status_targets()
+    except ClusterError as e:
+        logging.error(f"Status check skipped: {e}")
+        return
+    for target in status_targets:
+        status_channel_id = target['channel_id']
+        channel = client.get_channel(int(status_channel_id)) if status_channel_id else None
+        if channel and target['servers']:
+            targets.append((target, channel))
+    if not targets:
         return
-    online_servers = []
-    offline_servers = []
-    for server_name, server_info in servers.items():
-        ip = server_info['ip']
-        port = server_info['port']
-        endpoint = f"http://{ip}:{port}/status"
+
+    # A server watched by several guilds is probed only once
+    unique_servers = {}
+    for target, _ in targets:
+        for server_info in target['servers'].values():
+            unique_servers[server_key(server_info)] = server_info
+    try:
+        results = await status_results(unique_servers)
+    except ClusterError as e:
+        logging.error(f"Status check skipped: {e}")
+        return
+
+    for target, channel in targets:
+        online_servers = []
+        offline_servers = []
+        for server_name, server_info in target['servers'].items():
+            summary = results[server_key(server_info)]
+            if summary['online']:
+                online_servers.append(format_server_status(server_name, summary))
+            else:
+                offline_servers.append(format_server_status(server_name, summary))
+        state = frozenset(
+            (server_name, results[server_key(server_info)]['online'])
+            for server_name, server_info in target['servers'].items()
+        )
+        status_message = (
+            "     **DN STATUS**\n\n"
+            "**Server Status**\n"
+            f"**ONLINE SERVERS 🟢:**\n{', '.join(online_servers) if online_servers else 'None'}\n"
+            f"**Offline servers 🔴:**\n{', '.join(offline_servers) if offline_servers else 'None'}\n"
+        )
+        await update_status_message(target, channel, status_message, state)
+
+async def update_status_message(target, channel, status_message, state=None):
+    guild_id = target['guild_id']
+    previous = previous_statuses.get(guild_id)
+    if previous is not None:
+        previous_message, previous_state, sent_at = previous
+        if status_message == previous_message:
+            return
+        # Only the uptime/latency figures moved: refresh those at a slower pace
+        if state is not None and state == previous_state and time.monotonic() - sent_at < STATUS_STATS_REFRESH:
+            return
+    # Reuse the message object from last time instead of fetching it every tick
+    msg_obj = status_message_objects.get(guild_id)
+    if msg_obj is not None and msg_obj.channel.id != channel.id:
+        msg_obj = None
+    if msg_obj is None and target['message_id']:
+        msg_obj = channel.get_partial_message(int(target['message_id']))
+    if msg_obj is not None:
         try:
-            response = requests.get(endpoint, timeout=5)
-            response.raise_for_status()
-            online_servers.append(f"{server_name} 🟢")
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Error querying server {server_name} status: {e}")
-            offline_servers.append(f"{server_name} 🔴")
-    status_message = (
-        "     **DN STATUS**\n\n"
-        "**Server Status**\n"
-        f"**ONLINE SERVERS 🟢:**\n{', '.join(online_servers) if online_servers else 'None'}\n"
-        f"**Offline servers 🔴:**\n{', '.join(offline_servers) if offline_servers else 'None'}\n"
-    )
-    global previous_statuses
-    if status_message != previous_statuses.get('status_message'):
-        if 'status_message_id' in status_messages:
-            try:
-                msg_obj = await channel.fetch_message(status_messages['status_message_id'])
-                await msg_obj.edit(content=status_message)
-            except discord.NotFound:
-                msg_obj = await channel.send(status_message)
-                status_messages['status_message_id'] = msg_obj.id
-        else:
-            msg_obj = await channel.send(status_message)
-            status_messages['status_message_id'] = msg_obj.id
-        previous_statuses['status_message'] = status_message
-        save_status_messages(status_messages)
+            msg_obj = await outbound.edit_message(msg_obj, status_message)
+        except discord.NotFound:
+            msg_obj = None
+    if msg_obj is None:
+        msg_obj = await outbound.call('send_message', channel.id, channel.send, status_message)
+        await storage.set_status_message(guild_id, msg_obj.id)
+    status_message_objects[guild_id] = msg_obj
+    previous_statuses[guild_id] = (status_message, state, time.monotonic())
 
+# Last status text sent (with the server states it showed and when), and the message holding it, per guild
 previous_statuses = {}
+status_message_objects = {}
 
 async def handle_rate_limits(func, *args, **kwargs):
     retries = 5
@@ -311,7 +2583,7 @@ async def handle_rate_limits(func, *args, **kwargs):
             return await func(*args, **kwargs)
         except discord.errors.HTTPException as e:
             if e.status == 429:
-                retry_after = int(e.response.headers.get('Retry-After', delay))
+                retry_after = float(e.response.headers.get('Retry-After', delay))
                 logging.warning(f"Rate limited. Retrying in {retry_after} seconds...")
                 await asyncio.sleep(retry_after)
                 delay *= 2
@@ -319,25 +2591,233 @@ async def handle_rate_limits(func, *args, **kwargs):
                 raise
     raise Exception("Max retries exceeded")
 
+class TokenBucket:
+    """
+    `capacity` requests per `per` seconds. Callers reserve a token up front and are
+    told how long to wait for it, so queued requests go out in order.
+    """
+    def __init__(self, capacity, per):
+        self.capacity = capacity
+        self.rate = capacity / per
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+# Discord's limits per route, bucketed like discord.py's Route by the major parameter
+# (channel ID for messages, interaction token for followups)
+DISCORD_ROUTE_LIMITS = {
+    'send_message': (5, 5.0),
+    'edit_message': (5, 5.0),
+    'followup': (5, 2.0),
+    'sync_commands': (2, 60.0),
+}
+DISCORD_GLOBAL_LIMIT = (50, 1.0)
+
+class OutboundScheduler:
+    """
+    Paces every outbound Discord request through a global bucket and a per-route bucket
+    so we stay under the limits instead of reacting to 429s. Repeated edits of the same
+    message are merged so only the latest content is sent.
+    """
+    def __init__(self):
+        self.global_bucket = TokenBucket(*DISCORD_GLOBAL_LIMIT)
+        self.buckets = {}
+        self.pending_edits = {}
+        self.edit_tasks = {}
+
+    def _bucket(self, route, major):
+        key = (route, major)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) > 1000:
+                self.prune()
+            bucket = self.buckets[key] = TokenBucket(*DISCORD_ROUTE_LIMITS.get(route, DISCORD_GLOBAL_LIMIT))
+        return bucket
+
+    async def _wait_turn(self, route, major):
+        wait = max(self._bucket(route, major).reserve(), self.global_bucket.reserve())
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def call(self, route, major, func, *args, **kwargs):
+        await self._wait_turn(route, major)
+        return await handle_rate_limits(func, *args, **kwargs)
+
+    def edit_message(self, message, content):
+        """
+        Queue an edit and return an awaitable for the edited message. An edit still
+        waiting for its turn is replaced rather than sent twice.
+        """
+        self.pending_edits[message.id] = content
+        task = self.edit_tasks.get(message.id)
+        if task is None or task.done():
+            task = self.edit_tasks[message.id] = asyncio.ensure_future(self._edit_worker(message))
+        return asyncio.shield(task)
+
+    async def _edit_worker(self, message):
+        message_id = message.id
+        try:
+            while message_id in self.pending_edits:
+                await self._wait_turn('edit_message', message.channel.id)
+                content = self.pending_edits.pop(message_id)
+                message = await handle_rate_limits(message.edit, content=content) or message
+            return message
+        finally:
+            self.pending_edits.pop(message_id, None)
+            self.edit_tasks.pop(message_id, None)
+
+    def prune(self):
+        """Drop buckets that have refilled completely."""
+        now = time.monotonic()
+        for key, bucket in list(self.buckets.items()):
+            if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.capacity:
+                del self.buckets[key]
+
+outbound = OutboundScheduler()
+
+async def send_followup(interaction, content, **kwargs):
+    return await outbound.call('followup', interaction.token, interaction.followup.send, content, **kwargs)
+
+def command_tree_hash(tree):
+    """Stable hash of the command payloads Discord would receive from a sync."""
+    payloads = []
+    for command in tree.get_commands():
+        try:
+            payloads.append(command.to_dict(tree))
+        except TypeError:
+            # discord.py before 2.4 takes no tree argument
+            payloads.append(command.to_dict())
+    payloads.sort(key=lambda payload: payload['name'])
+    return hashlib.sha256(json.dumps(payloads, sort_keys=True).encode()).hexdigest()
+
+async def sync_commands_if_changed():
+    """Sync the command tree only when it differs from what this application last synced."""
+    digest = command_tree_hash(client.tree)
+    synced = load_json(COMMAND_SYNC_FILE)
+    if synced.get(str(client.application_id)) == digest:
+        logging.info("Command tree unchanged, skipping sync")
+        return False
+    await outbound.call('sync_commands', None, client.tree.sync)
+    synced[str(client.application_id)] = digest
+    save_json(COMMAND_SYNC_FILE, synced)
+    logging.info("Command tree synced")
+    return True
+
+startup_seconds = None
+disconnected_at = None
+
+# Cluster workers connect only their own shards; a single process keeps one connection
+BOT_CLASS = commands.AutoShardedBot if SHARD_IDS else commands.Bot
+
+async def shutdown_services():
+    """Stop the background services and write out pending changes. Used by both the bot and the coordinator."""
+    await stop_metrics_server()
+    await close_http_session()
+    stream_cache.flush()
+    title_index.flush()
+    cancel_loudness_analysis()
+    loudness_cache.flush()
+    for config in config_files.values():
+        config.flush()
+    extraction_service.shutdown()
+    await storage.close()
+
+class MusicBot(BOT_CLASS):
+    async def setup_hook(self):
+        # Runs once per process, unlike on_ready which fires again after every reconnect
+        await start_metrics_server()
+        if cluster is not None:
+            try:
+                for url, title in (await cluster.request('titles')).items():
+                    title_index.add(title, url, save=False)
+            except ClusterError as e:
+                logging.error(f"Could not load titles from the coordinator: {e}")
+        # Every worker registers the same commands, so one sync is enough
+        if CLUSTER_WORKER_ID in (None, '0'):
+            try:
+                await sync_commands_if_changed()
+            except discord.HTTPException as e:
+                logging.error(f"Command sync failed: {e}")
+
+    async def close(self):
+        await shutdown_services()
+        await super().close()
+
 intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True
-client = commands.Bot(command_prefix="!", intents=intents)
+shard_options = {'shard_ids': SHARD_IDS, 'shard_count': SHARD_COUNT} if SHARD_IDS else {}
+client = MusicBot(command_prefix="!", intents=intents, **shard_options)
+
+@client.event
+async def on_disconnect():
+    global disconnected_at
+    if disconnected_at is None:
+        disconnected_at = time.monotonic()
 
 @client.event
 async def on_ready():
-    logging.info(f'Logged in as {client.user}')
-    await handle_rate_limits(client.tree.sync)
-    check_voice_channel.start()
-    check_server_status.start()
+    global startup_seconds, disconnected_at
+    now = time.monotonic()
+    if startup_seconds is None:
+        startup_seconds = now - PROCESS_STARTED
+        logging.info(f'Logged in as {client.user}, ready {startup_seconds:.2f}s after start')
+        if isinstance(storage, RemoteStorage):
+            logging.info(f'Cluster worker {CLUSTER_WORKER_ID} running shards {SHARD_IDS} of {SHARD_COUNT}')
+        elif isinstance(storage, SqliteStorage):
+            channel_guilds = {}
+            for guild in client.guilds:
+                for channel in guild.channels:
+                    channel_guilds[str(channel.id)] = guild.id
+            await storage.migrate_json(channel_guilds)
+        # Warm yt-dlp in the background so the first /playbot doesn't pay for the import
+        asyncio.get_running_loop().run_in_executor(None, load_youtube_dl)
+    elif disconnected_at is not None:
+        metrics.reconnect.observe(now - disconnected_at)
+        logging.info(f'Reconnected as {client.user} after {now - disconnected_at:.2f}s')
+    disconnected_at = None
+    if not check_server_status.is_running():
+        check_server_status.start()
+
+@client.event
+async def on_resumed():
+    global disconnected_at
+    if disconnected_at is not None:
+        metrics.reconnect.observe(time.monotonic() - disconnected_at)
+        logging.info(f'Session resumed after {time.monotonic() - disconnected_at:.2f}s')
+    disconnected_at = None
+
+@client.event
+async def on_voice_state_update(member, before, after):
+    guild = member.guild
+    if member.id == client.user.id and after.channel is None:
+        # The bot left voice (Disconnect button, kicked, idle): nothing left to play
+        timer = idle_timers.pop(guild.id, None)
+        if timer is not None:
+            timer.cancel()
+        release_guild_resources(guild.id, guild.voice_client)
+        return
+    voice_client = guild.voice_client
+    if voice_client is None:
+        return
+    # Only changes touching the bot's channel can change whether it is alone
+    if voice_client.channel in (before.channel, after.channel) or member.id == client.user.id:
+        update_idle_timer(guild)
 
-@client.tree.command(name="playbot", description="Play a YouTube video in a voice channel")
-@app_commands.describe(url="The URL of the YouTube video")
+@client.tree.command(name="playbot", description="Play a YouTube video or playlist in a voice channel")
+@app_commands.describe(url="A YouTube link, or text to search for")
 async def playbot(interaction: discord.Interaction, url: str):
+    requested_at = time.perf_counter()
     await interaction.response.defer()
-    publicp = load_publicp()
-    text_channel_id = publicp.get('text_channel_id')
-    voice_channel_id = publicp.get('voice_channel_id')
+    channels = await storage.get_channels(interaction.guild.id)
+    text_channel_id = channels.get('text_channel_id')
+    voice_channel_id = channels.get('voice_channel_id')
 
     # Check channel requirements
     if text_channel_id and voice_channel_id:
@@ -346,41 +2826,44 @@ async def playbot(interaction: discord.Interaction, url: str):
                 pass
             else:
                 vc_obj = interaction.guild.get_channel(int(voice_channel_id))
-                await interaction.followup.send(
+                await send_followup(
+                    interaction,
                     f"You must be in the voice channel: {vc_obj.name}",
                     ephemeral=True
                 )
                 return
         else:
-            whitelisted_users = load_whitelist()
-            if (str(interaction.user.id) not in whitelisted_users and
-                    str(client.user.id) not in whitelisted_users):
+            if not await storage.is_whitelisted(interaction.guild.id, str(interaction.user.id), str(client.user.id)):
                 text_channel = interaction.guild.get_channel(int(text_channel_id)) if text_channel_id else None
                 channel_name = text_channel.name if text_channel else "specified channel"
-                await interaction.followup.send(
+                await send_followup(
+                    interaction,
                     f"Please use the command in the {channel_name}",
                     ephemeral=True
                 )
                 return
     else:
-        whitelisted_users = load_whitelist()
-        if (str(interaction.user.id) not in whitelisted_users and
-                str(client.user.id) not in whitelisted_users):
-            await interaction.followup.send(
+        if not await storage.is_whitelisted(interaction.guild.id, str(interaction.user.id), str(client.user.id)):
+            await send_followup(
+                interaction,
                 "You are not whitelisted to use this command.",
                 ephemeral=True
             )
             return
 
-    # Basic YouTube check
-    if "youtube.com" not in url and "youtu.be" not in url:
-        await interaction.followup.send("The provided URL is not a valid YouTube video.", ephemeral=True)
-        return
-
     if not interaction.user.voice:
-        await interaction.followup.send("You must be in a voice channel to use this command.", ephemeral=True)
+        await send_followup(interaction, "You must be in a voice channel to use this command.", ephemeral=True)
         return
 
+    # Anything that isn't a YouTube link is searched for
+    if "youtube.com" not in url and "youtu.be" not in url:
+        results = await search_youtube(url)
+        if not results:
+            await send_followup(interaction, "No YouTube results found for that search.", ephemeral=True)
+            return
+        url = results[0]['url']
+    playlist = extract_playlist_id(url) is not None
+
     channel = interaction.user.voice.channel
     voice_client = interaction.guild.voice_client
     if voice_client is None:
@@ -388,26 +2871,175 @@ async def playbot(interaction: discord.Interaction, url: str):
     elif voice_client.channel != channel:
         await voice_client.move_to(channel)
 
-    # Stop the currently playing/paused audio if any
-    if voice_client.is_playing() or voice_client.is_paused():
-        voice_client.stop()
+    # Queue the track if something is already playing or about to
+    queue = get_guild_queue(interaction.guild.id)
+    pending = pending_plays.get(interaction.guild.id)
+    if voice_client.is_playing() or voice_client.is_paused() or (pending and not pending.done()):
+        enqueue = queue.enqueue_playlist if playlist else queue.enqueue
+        position = enqueue(url, requester=interaction.user.id)
+        if position is None:
+            await send_followup(interaction, f"The queue is full ({QUEUE_MAX_LENGTH} tracks).", ephemeral=True)
+            return
+        queue.schedule_prefetch(voice_client)
+        controls = getattr(voice_client, "player_controls", None)
+        kwargs = {'view': controls} if controls else {}
+        what = "the playlist to" if playlist else "to"
+        await send_followup(interaction, f"Added {what} the queue at position {position}.", ephemeral=True, **kwargs)
+        return
+
+    first_audio = (metrics.time_to_first_audio, requested_at)
+    if playlist:
+        # Nothing is playing, so the queue is empty and the playlist starts right away
+        if queue.enqueue_playlist(url, requester=interaction.user.id) is None:
+            await send_followup(interaction, f"The queue is full ({QUEUE_MAX_LENGTH} tracks).", ephemeral=True)
+            return
+        task = asyncio.ensure_future(play_next(voice_client, first_audio=first_audio))
+    else:
+        task = asyncio.ensure_future(play_audio(voice_client, url, volume=1.0, first_audio=first_audio))
+    pending_plays[interaction.guild.id] = task
 
     try:
-        source = await play_audio(voice_client, url, volume=1.0)
+        try:
+            source = await task
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            controls = start_queued_tracks(voice_client)
+            kwargs = {'view': controls} if controls else {}
+            await send_followup(interaction, "This request was cancelled.", ephemeral=True, **kwargs)
+            return
+        finally:
+            if pending_plays.get(interaction.guild.id) is task:
+                del pending_plays[interaction.guild.id]
         if source:
             controls = PlayerControls(voice_client)
-            controls.last_url = url
+            controls.last_url = queue.current['url']
             voice_client.player_controls = controls
-            await interaction.followup.send(
+            await send_followup(
+                interaction,
                 "Now playing your requested audio.",
                 view=controls,
                 ephemeral=True
             )
+            metrics.playbot.observe(time.perf_counter() - requested_at)
         else:
-            await interaction.followup.send("An error occurred while trying to play the audio.", ephemeral=True)
+            controls = start_queued_tracks(voice_client)
+            kwargs = {'view': controls} if controls else {}
+            await send_followup(interaction, "An error occurred while trying to play the audio.", ephemeral=True, **kwargs)
     except Exception as e:
         logging.error(f"Error: {e}")
-        await interaction.followup.send("An error occurred while trying to play the audio.", ephemeral=True)
+        controls = start_queued_tracks(voice_client)
+        kwargs = {'view': controls} if controls else {}
+        await send_followup(interaction, "An error occurred while trying to play the audio.", ephemeral=True, **kwargs)
+
+# Latest keystroke and in-flight remote search per user, so superseded queries drop out
+autocomplete_tokens = {}
+autocomplete_searches = {}
+
+@playbot.autocomplete('url')
+async def playbot_autocomplete(interaction: discord.Interaction, current: str):
+    """
+    Suggest tracks for the text typed so far.
+    Local title matches answer immediately; the extractor is only asked once the user
+    pauses typing, and a newer keystroke cancels the older search.
+    """
+    started = time.perf_counter()
+    query = current.strip()
+    if not query or "youtube.com" in query or "youtu.be" in query:
+        return []
+    suggestions = title_index.search(query, AUTOCOMPLETE_CHOICES)
+    results = search_cache.get(normalize_title(query))
+    if results is None and len(suggestions) < AUTOCOMPLETE_CHOICES and len(query) >= AUTOCOMPLETE_MIN_CHARS:
+        user_id = interaction.user.id
+        token = autocomplete_tokens[user_id] = object()
+        await asyncio.sleep(AUTOCOMPLETE_DEBOUNCE)
+        if autocomplete_tokens.get(user_id) is token:
+            previous = autocomplete_searches.pop(user_id, None)
+            if previous is not None:
+                previous.cancel()
+            search = autocomplete_searches[user_id] = asyncio.ensure_future(search_youtube(query))
+            # Whatever isn't back by the deadline is left for the next keystroke's cache lookup
+            await asyncio.wait({search}, timeout=max(0.0, AUTOCOMPLETE_BUDGET - (time.perf_counter() - started)))
+            if search.done() and not search.cancelled():
+                results = search.result()
+            if autocomplete_tokens.get(user_id) is token:
+                del autocomplete_tokens[user_id]
+                if search.done():
+                    autocomplete_searches.pop(user_id, None)
+    for result in results or ():
+        if len(suggestions) >= AUTOCOMPLETE_CHOICES:
+            break
+        if all(url != result['url'] for _, url in suggestions):
+            suggestions.append((result['title'], result['url']))
+    metrics.autocomplete.observe(time.perf_counter() - started)
+    return [app_commands.Choice(name=title[:100], value=url) for title, url in suggestions]
+
+@client.tree.command(name="skip", description="Skip to the next track in the queue")
+async def skip(interaction: discord.Interaction):
+    voice_client = interaction.guild.voice_client
+    if not voice_client or not interaction.user.voice or interaction.user.voice.channel != voice_client.channel:
+        await interaction.response.send_message("You must be in the bot's voice channel to skip.", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True)
+    message = await skip_track(voice_client)
+    await send_followup(interaction, message, ephemeral=True)
+
+@client.tree.command(name="queue", description="List the upcoming tracks")
+async def queue_list(interaction: discord.Interaction):
+    queue = get_guild_queue(interaction.guild.id)
+    lines = []
+    if queue.current:
+        lines.append(f"Now playing: {queue.current.get('title') or queue.current['url']}")
+    for position, track in enumerate(list(queue.tracks)[:10], start=1):
+        if 'feed' in track:
+            lines.append(f"{position}. Playlist: {track['feed'].title or track['url']} (more tracks to come)")
+        else:
+            lines.append(f"{position}. {track['title'] or track['url']}")
+    if len(queue.tracks) > 10:
+        lines.append(f"...and {len(queue.tracks) - 10} more")
+    await interaction.response.send_message("\n".join(lines) if lines else "The queue is empty.", ephemeral=True)
+
+@client.tree.command(name="streamstats", description="Show CPU use of each active voice stream")
+async def streamstats(interaction: discord.Interaction):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You do not have permission to use this command.", ephemeral=True)
+        return
+    lines = []
+    for voice_client in client.voice_clients:
+        source = voice_client.source
+        if not isinstance(source, MeteredSource):
+            continue
+        report = source.cpu_report()
+        ffmpeg_cpu = f"{report['ffmpeg']:.1f}%" if report['ffmpeg'] is not None else "n/a"
+        lines.append(
+            f"{voice_client.guild.name}: {report['mode']} @ {report['position']:.0f}s, "
+            f"FFmpeg {ffmpeg_cpu}, Python {report['python']:.1f}%"
+        )
+    if lines:
+        await interaction.response.send_message("Active streams:\n" + "\n".join(lines), ephemeral=True)
+    else:
+        await interaction.response.send_message("No audio is currently playing.", ephemeral=True)
+
+@client.tree.command(name="metrics", description="Show playback and status latency metrics")
+async def metrics_command(interaction: discord.Interaction):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You do not have permission to use this command.", ephemeral=True)
+        return
+
+    def ms(seconds):
+        return f"{seconds * 1000:.0f} ms" if seconds is not None and seconds != float('inf') else "n/a"
+
+    lines = []
+    for histogram in metrics.all():
+        if isinstance(histogram, Histogram):
+            lines.append(
+                f"{histogram.name}: n={histogram.count}, "
+                f"p50 ≤ {ms(histogram.percentile(0.5))}, p99 ≤ {ms(histogram.percentile(0.99))}"
+            )
+    for counter in metrics.all():
+        if isinstance(counter, Counter):
+            lines.append(f"{counter.name}: {counter.get()}")
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
 
 @client.tree.command(name="whitelist", description="Whitelist a user to use the bot")
 @app_commands.describe(user="The user to whitelist")
@@ -415,10 +3047,7 @@ async def whitelist(interaction: discord.Interaction, user: discord.Member):
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("You do not have permission to use this command.", ephemeral=True)
         return
-    whitelisted_users = load_whitelist()
-    if str(user.id) not in whitelisted_users:
-        whitelisted_users.append(str(user.id))
-        save_whitelist(whitelisted_users)
+    if await storage.add_whitelist(interaction.guild.id, str(user.id)):
         await interaction.response.send_message(f"User {user.mention} has been whitelisted.", ephemeral=True)
     else:
         await interaction.response.send_message(f"User {user.mention} is already whitelisted.", ephemeral=True)
@@ -429,9 +3058,7 @@ async def setmchanneltext(interaction: discord.Interaction, text_channel_id: str
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("You do not have permission to use this command.", ephemeral=True)
         return
-    publicp = load_publicp()
-    publicp['text_channel_id'] = text_channel_id
-    save_publicp(publicp)
+    await storage.set_channel(interaction.guild.id, 'text_channel_id', text_channel_id)
     await interaction.response.send_message(f"Text channel set to {text_channel_id}.", ephemeral=True)
 
 @client.tree.command(name="setmchannelvc", description="Set the voice channel for the bot")
@@ -440,9 +3067,7 @@ async def setmchannelvc(interaction: discord.Interaction, voice_channel_id: str)
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("You do not have permission to use this command.", ephemeral=True)
         return
-    publicp = load_publicp()
-    publicp['voice_channel_id'] = voice_channel_id
-    save_publicp(publicp)
+    await storage.set_channel(interaction.guild.id, 'voice_channel_id', voice_channel_id)
     await interaction.response.send_message(f"Voice channel set to {voice_channel_id}.", ephemeral=True)
 
 @client.tree.command(name="remchanneltext", description="Remove the text channel for the bot")
@@ -450,9 +3075,7 @@ async def remchanneltext(interaction: discord.Interaction):
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("You do not have permission to use this command.", ephemeral=True)
         return
-    publicp = load_publicp()
-    publicp.pop('text_channel_id', None)
-    save_publicp(publicp)
+    await storage.set_channel(interaction.guild.id, 'text_channel_id', None)
     await interaction.response.send_message("Text channel has been removed.", ephemeral=True)
 
 @client.tree.command(name="remchannelvc", description="Remove the voice channel for the bot")
@@ -460,16 +3083,14 @@ async def remchannelvc(interaction: discord.Interaction):
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("You do not have permission to use this command.", ephemeral=True)
         return
-    publicp = load_publicp()
-    publicp.pop('voice_channel_id', None)
-    save_publicp(publicp)
+    await storage.set_channel(interaction.guild.id, 'voice_channel_id', None)
     await interaction.response.send_message("Voice channel has been removed.", ephemeral=True)
 
 @client.tree.command(name="mchannellist", description="Get the list of the current text and voice channels")
 async def mchannellist(interaction: discord.Interaction):
-    publicp = load_publicp()
-    text_channel_id = publicp.get('text_channel_id', 'Not set')
-    voice_channel_id = publicp.get('voice_channel_id', 'Not set')
+    channels = await storage.get_channels(interaction.guild.id)
+    text_channel_id = channels.get('text_channel_id') or 'Not set'
+    voice_channel_id = channels.get('voice_channel_id') or 'Not set'
     await interaction.response.send_message(
         f"Text channel: {text_channel_id}\nVoice channel: {voice_channel_id}",
         ephemeral=True
@@ -481,7 +3102,7 @@ async def setstatuschannel(interaction: discord.Interaction, channel_id: str):
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("You do not have permission to use this command.", ephemeral=True)
         return
-    save_status_channel(channel_id)
+    await storage.set_status_channel(interaction.guild.id, channel_id)
     await interaction.response.send_message(f"Status channel set to {channel_id}.", ephemeral=True)
 
 @client.tree.command(name="addserver", description="Add a server to monitor")
@@ -490,9 +3111,7 @@ async def addserver(interaction: discord.Interaction, name: str, ip: str, port:
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("You do not have permission to use this command.", ephemeral=True)
         return
-    servers = load_servers()
-    servers[name] = {'ip': ip, 'port': port}
-    save_servers(servers)
+    await storage.add_server(interaction.guild.id, name, ip, port)
     await interaction.response.send_message(f"Server '{name}' added with IP {ip} and port {port}.", ephemeral=True)
 
 @client.tree.command(name="removeserver", description="Remove a server from monitoring")
@@ -501,22 +3120,160 @@ async def removeserver(interaction: discord.Interaction, name: str):
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("You do not have permission to use this command.", ephemeral=True)
         return
-    servers = load_servers()
-    if name in servers:
-        del servers[name]
-        save_servers(servers)
+    if await storage.remove_server(interaction.guild.id, name):
         await interaction.response.send_message(f"Server '{name}' removed.", ephemeral=True)
     else:
         await interaction.response.send_message(f"Server '{name}' not found.", ephemeral=True)
 
 @client.tree.command(name="listservers", description="List all monitored servers")
 async def listservers(interaction: discord.Interaction):
-    servers = load_servers()
+    servers = await storage.get_servers(interaction.guild.id)
     if servers:
-        server_list = "\n".join([f"{name}: {info['ip']}:{info['port']}" for name, info in servers.items()])
+        lines = []
+        for name, info in servers.items():
+            summary = server_summaries.get(server_key(info))
+            details = ""
+            if summary is not None and summary['uptime'] is not None:
+                details = f" ({summary['uptime'] * 100:.0f}% up"
+                if summary['p50'] is not None:
+                    details += f", p50 {summary['p50'] * 1000:.0f} ms"
+                details += ")"
+            lines.append(f"{name}: {info['ip']}:{info['port']}{details}")
+        server_list = "\n".join(lines)
         await interaction.response.send_message(f"Monitored servers:\n{server_list}", ephemeral=True)
     else:
         await interaction.response.send_message("No servers are currently being monitored.", ephemeral=True)
 
-logging.basicConfig(level=logging.INFO)
-client.run(os.getenv('token'))
+class ClusterCoordinator:
+    """
+    Serves the shared state to cluster workers: storage, stream resolution and search
+    (through this process's stream cache and extraction pool) and status probes.
+    """
+    def __init__(self, token):
+        self.token = token
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, '127.0.0.1', CLUSTER_PORT, limit=2 ** 22)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        try:
+            hello = json.loads(await reader.readline() or b'{}')
+        except json.JSONDecodeError:
+            hello = {}
+        if not secrets.compare_digest(str(hello.get('token')), self.token):
+            writer.close()
+            return
+        tasks_running = set()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            task = asyncio.ensure_future(self._handle(json.loads(line), writer))
+            tasks_running.add(task)
+            task.add_done_callback(tasks_running.discard)
+        writer.close()
+
+    async def _handle(self, request, writer):
+        try:
+            reply = {'id': request['id'], 'result': await self.dispatch(request['op'], *request['args'])}
+        except Exception as e:
+            reply = {'id': request['id'], 'error': f"{type(e).__name__}: {e}"}
+        if not writer.is_closing():
+            writer.write((json.dumps(reply) + "\n").encode())
+            await writer.drain()
+
+    async def dispatch(self, op, *args):
+        if op == 'storage':
+            method, *args = args
+            if method not in REMOTE_STORAGE_METHODS:
+                raise ClusterError(f"Unknown storage method {method}")
+            return await getattr(storage, method)(*args)
+        if op == 'resolve':
+            return await resolve_stream(*args)
+        if op == 'search':
+            return await search_youtube(*args)
+        if op == 'probe':
+            return await status_monitor.poll(*args)
+        if op == 'titles':
+            return dict(title_index.titles)
+        if op == 'invalidate':
+            return stream_cache.invalidate(*args)
+        if op == 'loudness':
+            video_id, audio_url = args
+            task = schedule_loudness(video_id, audio_url)
+            if task is not None:
+                # Shielded so a worker going away doesn't abort a measurement others share
+                await asyncio.shield(task)
+            return loudness_cache.peek(video_id)
+        raise ClusterError(f"Unknown operation {op}")
+
+async def recommended_shard_count(token):
+    session = await get_http_session()
+    async with session.get(
+        'https://discord.com/api/v10/gateway/bot', headers={'Authorization': f'Bot {token}'}
+    ) as response:
+        response.raise_for_status()
+        return (await response.json())['shards']
+
+async def run_worker(worker_id, shard_ids, shard_count, token):
+    """Run one worker process, restarting it whenever it exits."""
+    env = dict(os.environ)
+    env.update({
+        'CLUSTER_WORKER_ID': str(worker_id),
+        'CLUSTER_TOKEN': token,
+        'SHARD_IDS': ','.join(map(str, shard_ids)),
+        'SHARD_COUNT': str(shard_count),
+    })
+    if METRICS_PORT:
+        env['METRICS_PORT'] = str(METRICS_PORT + 1 + worker_id)
+    while True:
+        process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+        try:
+            code = await process.wait()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.terminate()
+                await process.wait()
+            raise
+        logging.warning(f"Worker {worker_id} exited with code {code}, restarting in 5s")
+        await asyncio.sleep(5)
+
+async def run_coordinator(bot_token):
+    shard_count = SHARD_COUNT or await recommended_shard_count(bot_token)
+    shard_count = max(shard_count, CLUSTER_WORKERS)
+    token = secrets.token_hex(16)
+    coordinator = ClusterCoordinator(token)
+    await coordinator.start()
+    await start_metrics_server()
+    logging.info(f"Coordinator listening on port {CLUSTER_PORT}, {CLUSTER_WORKERS} workers for {shard_count} shards")
+    workers = []
+    try:
+        for worker_id in range(CLUSTER_WORKERS):
+            shard_ids = list(range(worker_id, shard_count, CLUSTER_WORKERS))
+            workers.append(asyncio.ensure_future(run_worker(worker_id, shard_ids, shard_count, token)))
+            # Discord allows one IDENTIFY per 5 seconds; let this worker's shards get through first
+            await asyncio.sleep(5.5 * len(shard_ids))
+        await asyncio.gather(*workers)
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await coordinator.stop()
+        await shutdown_services()
+
+if __name__ == "__main__":
+    # Guarded so EXTRACT_MODE=process workers can re-import this module safely
+    logging.basicConfig(level=logging.INFO)
+    if CLUSTER_WORKERS > 1 and cluster is None:
+        try:
+            asyncio.run(run_coordinator(os.getenv('token')))
+        except KeyboardInterrupt:
+            pass
+    else:
+        client.run(os.getenv('token'))